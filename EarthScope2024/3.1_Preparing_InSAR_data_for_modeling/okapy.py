@@ -1,19 +1,221 @@
 # okapy.py - a set of functions that compute Okada dislocation models and penalties
-# (basically a wrapper for ben thompson's okada_wrapper)
-# plenty more work to be done - can only handle one fault and one dataset right now
-# - but you've got to start somewhere, eh?
+# (started life as a wrapper for ben thompson's okada_wrapper, now vectorised numpy)
+# plenty more work to be done - several datasets (joint_dataset) and several sources
+# (CompositeModel) can be modelled together now, but distributed slip is still only on
+# one planar fault - but you've got to start somewhere, eh?
 #
 # gjf, 13-jul-2020
 # github.com/geniusinaction
 #
 # change history:
 # 12-aug-2020  gjf  added tensile dislocation functions (rect_tensile_fault, los_penalty_tensile)
+# 18-oct-2026       replaced the per-point dc3dwrapper loops with a vectorised surface kernel (dc3d_surface)
+# 18-oct-2026       added cached unit-slip Green's vectors (shear_greens), used by los_penalty_fault
+#                   (bounded in bytes, with entries dropped along with their data - forget_greens)
+# 18-oct-2026       added variable projection inversion (linear_fit_fault, los_penalty_varpro, invert_fault_varpro)
+# 18-oct-2026       added parallel multistart inversion (random_start, multistart_invert)
+# 18-oct-2026       added batched forward models and penalties (rect_shear_fault_batch, los_penalty_fault_batch)
+# 18-oct-2026       added ensemble MCMC sampler (log_posterior_fault_batch, mcmc_sample)
+# 18-oct-2026       added gridded displacement maps (rect_shear_fault_grid, geotransform_axes, los_vector)
+# 18-oct-2026       added joint inversion of several datasets (joint_dataset, rect_shear_fault_joint,
+#                   los_penalty_fault_joint)
+# 18-oct-2026       added covariance weighted penalties with cached Cholesky factors (exponential_covariance,
+#                   whitening_factor, los_penalty_fault_cov)
+# 18-oct-2026       added distributed slip inversion (mesh_fault, distributed_greens, laplacian_operator,
+#                   distributed_slip_system, solve_distributed_slip, invert_distributed_slip, lcurve)
+# 18-oct-2026       added least squares inversion with batched Jacobians (los_residuals_fault,
+#                   los_jacobian_fault, invert_fault_lsq)
+# 18-oct-2026       added point and spherical sources (dc3d0_surface, point_dislocation, mogi_source,
+#                   mctigue_source and their los_penalty functions)
+# 18-oct-2026       added multi-source models with per-source caching (CompositeModel), and brought
+#                   the header up to date on what okapy can handle
+# 18-oct-2026       added quadtree decimation of interferograms using summed-area tables
+#                   (summed_area_table, quadtree_leaves, quadtree_decimate, read_interferogram,
+#                   quadtree_interferogram), so kite is no longer needed to make a data array
+# 18-oct-2026       added resolution-based resampling of interferograms (resolution_leaves,
+#                   resolution_decimate, utm_points), so data points follow the model's sensitivity
+# 18-oct-2026       added a loader for .okinv files that keeps a memory-mapped binary copy (load_okinv)
+# 18-oct-2026       added streaming full-resolution model and residual maps written to GeoTIFF
+#                   (stream_shear_fault, open_interferogram, read_interferogram_rows, utm_transform)
+# 18-oct-2026       added memoized penalties with hit/miss counts, optionally shared between
+#                   multistart workers (MemoPenalty)
+# 18-oct-2026       added parallel bootstrap, jackknife and correlated noise uncertainties
+#                   (bootstrap_invert)
+# 18-oct-2026       added a differential evolution global search, scored one generation at a time
+#                   with the batched penalties (evolve_invert)
 
 
-from okada_wrapper import dc3dwrapper
-from math import sin, cos, tan, radians
+from math import sin, cos, radians, degrees, atan2, hypot, pi
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory, Value
+from scipy.optimize import minimize, least_squares, lsq_linear, Bounds
+from scipy.linalg import cholesky, solve_triangular
+from scipy.sparse.linalg import LinearOperator, lsmr
+import scipy.sparse as sparse
+import hashlib
+import json
+import os
+import time
+import weakref
 import numpy as np
 
+# least-recently-used cache of unit-slip Green's vectors, keyed on fault geometry
+#   (entries go when their data array does, and the whole cache is bounded in bytes, since
+#   each entry is as long as the data)
+greens_cache = OrderedDict()
+greens_cache_bytes = 2**28   # most memory the cached vectors can take up (256 MB)
+greens_cache_nbytes = 0      # memory they take up now
+
+# least-recently-used cache of Cholesky factors of data covariance matrices
+#   (each one is n x n, so only keep a few)
+cholesky_cache = OrderedDict()
+cholesky_cache_size = 4
+
+# largest number of fault-point pairs the batch functions evaluate in one go
+#   (bounds the size of the temporary arrays, which scale with batch size times data length)
+batch_size = 2**20
+
+# scales for the finite difference steps of each fault parameter - steps are 1e-6 of
+#   (|value| + scale), so that zero-valued parameters (e.g. a top depth of 0) still move
+jacobian_scale = np.array([1.0, 1.0, 1.0, 0.1, 1e4, 1e4, 1e4, 1e4, 1e4])
+
+# positions of the nonlinear geometry parameters (strike, dip, x, y, length, top, bottom) in fparams
+geometry_index = [0, 1, 4, 5, 6, 7, 8]
+
+# read-only data array (and the shared memory behind it) in a multistart worker process
+worker_data = None
+worker_shm = None
+
+# which worker of its pool this process is (None outside worker_pool), numbered from 0
+worker_index = None
+
+# shared memory mapped by the MemoPenalty tables in this process, by name - one mapping per process
+memo_shms = {}
+
+def okada85_corner(xi, et, q, sd, cd, mr, kxi, ket):
+    "Okada (1985) surface displacement terms for one corner of a rectangular dislocation"
+
+    # xi, et and q are arrays of Okada's integration coordinates for this corner
+    # sd and cd are sin and cos of dip (scalars or arrays), mr is mu/(lambda+mu)
+    # kxi and ket flag points on the negative extension of the fault edges (as in DC3D)
+    # returns R and the [x, y, z] terms for strike-slip, dip-slip and tensile dislocations
+
+    r = np.sqrt(xi*xi + et*et + q*q)
+    yb = et*cd + q*sd   # y-tilde in Okada (1985)
+    db = et*sd - q*cd   # d-tilde in Okada (1985)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # singular terms are zeroed the same way DC3D does it
+        tt = np.where(q == 0.0, 0.0, np.arctan(xi*et/(q*r)))
+        ale = np.where(ket, -np.log(r-et), np.log(r+et))
+        y11 = np.where(ket, 0.0, 1.0/(r*(r+et)))
+        x11 = np.where(kxi, 0.0, 1.0/(r*(r+xi)))
+        rd = r + db
+
+        # the I terms, with the special case for vertical faults
+        #   (a batch of faults can have a mix of both, so only work out what's needed)
+        i1 = i3 = i4 = i5 = 0.0
+        if np.any(cd != 0.0):
+            xx = np.sqrt(xi*xi + q*q)
+            i5 = np.where(xi == 0.0, 0.0,
+                          mr*2/cd*np.arctan((et*(xx+q*cd) + xx*(r+xx)*sd)/(xi*(r+xx)*cd)))
+            i4 = mr/cd*(np.log(rd) - sd*ale)
+            i3 = mr*(yb/(cd*rd) - ale) + sd/cd*i4
+            i1 = -mr*xi/(cd*rd) - sd/cd*i5
+        if np.any(cd == 0.0):
+            vertical = (cd == 0.0)
+            i1 = np.where(vertical, -mr/2*xi*q/(rd*rd), i1)
+            i3 = np.where(vertical, mr/2*(et/rd + yb*q/(rd*rd) - ale), i3)
+            i4 = np.where(vertical, -mr*q/rd, i4)
+            i5 = np.where(vertical, -mr*xi*sd/rd, i5)
+        i2 = -mr*ale - i3
+
+        # here q*r*y11 stands in for q/(R+eta), which blows up on the fault extension
+        fss = [xi*q*y11 + tt + i1*sd,
+               yb*q*y11 + q*cd*r*y11 + i2*sd,
+               db*q*y11 + q*sd*r*y11 + i4*sd]
+        fds = [q/r - i3*sd*cd,
+               yb*q*x11 + cd*tt - i1*sd*cd,
+               db*q*x11 + sd*tt - i5*sd*cd]
+        fts = [q*q*y11 - i3*sd*sd,
+               -db*q*x11 - sd*(xi*q*y11 - tt) - i1*sd*sd,
+               yb*q*x11 + cd*(xi*q*y11 - tt) - i5*sd*sd]
+
+    return r, fss, fds, fts
+
+def dc3d_surface(alpha, x, y, depth, dip, al, aw, disl):
+    "Vectorised stand-in for dc3dwrapper, for observation points at the surface (z=0)"
+
+    # alpha is Okada's elastic constant (lambda+mu)/(lambda+2*mu)
+    # x and y are arrays of observation coordinates in Okada geometry
+    #   (x along strike, y perpendicular, relative to the reference point)
+    # depth is the depth of the reference point and dip is in degrees
+    # al and aw are the along-strike and down-dip extents, [al1, al2] and [aw1, aw2]
+    #   (depth, dip, al and aw can also be m x 1 arrays, one row per fault, giving m x n results)
+    # disl is the dislocation: strike-slip, dip-slip, opening
+    #   (or an m x 3 array of dislocations, giving m x n displacement arrays)
+    # returns arrays of x, y and z displacements in Okada geometry - at z=0 DC3D
+    #   reduces to the Okada (1985) half-space solution, which is what we evaluate
+    # agrees with dc3dwrapper to ~1e-6 relative away from the fault edges, but not right next
+    #   to the surface trace of a surface-breaking fault (top = 0), where both lose digits to
+    #   cancellation: ~3e-5 within a metre or so of the trace, a few percent within a millimetre,
+    #   and both give nan closer than ~0.1 mm (neither one is the "exact" answer there)
+
+    eps = 1.0e-6   # same rounding threshold as DC3D
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    sd = np.sin(np.radians(dip))
+    cd = np.cos(np.radians(dip))
+    vertical = np.abs(cd) < eps
+    cd = np.where(vertical, 0.0, cd)
+    sd = np.where(vertical, np.where(sd > 0, 1.0, -1.0), sd)
+    mr = 1/alpha - 1   # mu/(lambda+mu)
+
+    # integration coordinates at the four corners of the dislocation
+    p = y*cd + depth*sd
+    q = y*sd - depth*cd
+    q = np.where(np.abs(q) < eps, 0.0, q)
+    xi = [x-al[0], x-al[1]]
+    et = [p-aw[0], p-aw[1]]
+    xi = [np.where(np.abs(v) < eps, 0.0, v) for v in xi]
+    et = [np.where(np.abs(v) < eps, 0.0, v) for v in et]
+
+    # points on the fault edges are singular - DC3D gives up and returns zero there
+    singular = (q == 0.0) & (((xi[0]*xi[1] <= 0.0) & (et[0]*et[1] == 0.0)) |
+                             ((et[0]*et[1] <= 0.0) & (xi[0]*xi[1] == 0.0)))
+
+    # points on the negative extension of the fault edges
+    r12 = np.sqrt(xi[0]*xi[0] + et[1]*et[1] + q*q)
+    r21 = np.sqrt(xi[1]*xi[1] + et[0]*et[0] + q*q)
+    r22 = np.sqrt(xi[1]*xi[1] + et[1]*et[1] + q*q)
+    kxi = [(xi[0] < 0.0) & (r21+xi[1] < eps), (xi[0] < 0.0) & (r22+xi[1] < eps)]
+    ket = [(et[0] < 0.0) & (r12+et[1] < eps), (et[0] < 0.0) & (r22+et[1] < eps)]
+
+    # put the dislocation components first so that several can be broadcast at once,
+    #   one row of results per dislocation
+    disl = np.moveaxis(np.asarray(disl, dtype=float), -1, 0)
+    if disl.ndim > 1:
+        disl = disl[..., None]
+
+    u = [0.0, 0.0, 0.0]
+
+    # Chinnery's notation: f(x,p) - f(x,p-W) - f(x-L,p) + f(x-L,p-W)
+    for k in range(2):
+        for j in range(2):
+            sign = 1.0 if j == k else -1.0
+            r, fss, fds, fts = okada85_corner(xi[j], et[k], q, sd, cd, mr, kxi[k], ket[j])
+            for i in range(3):
+                ui = (-disl[0]*fss[i] - disl[1]*fds[i] + disl[2]*fts[i])/(2*pi)
+                u[i] = u[i] + sign*np.where(r == 0.0, 0.0, ui)
+
+    for i in range(3):
+        u[i] = np.where(singular, 0.0, u[i])
+
+    return u[0], u[1], u[2]
+
 def rect_shear_fault(fparams, eparams, data): 
     "Attempt at a functional Okada dislocation model - wish me luck!"
     
@@ -27,15 +229,44 @@ def rect_shear_fault(fparams, eparams, data):
     #   minimum 6 numbers: x_pos, y_pos, displacement, x_los, y_los, z_los
     #      positions, displacement in meters, rest are unit los vector components 
 
-    # fault parameters
-    strike = fparams[0]
-    dip = fparams[1]
+    # convert slip and rake to strike-slip and dip-slip
     rake = fparams[2]
     slip = fparams[3]
+    ss=slip*cos(radians(rake))
+    ds=slip*sin(radians(rake))
+
+    return shear_fault_los(fparams, eparams, data, [ss, ds, 0.0])
+
+def shear_fault_los(fparams, eparams, data, disl):
+    "LOS displacements for the geometry of an Okada rectangular fault and a given dislocation"
+
+    # fparams, eparams and data are as for rect_shear_fault (rake and slip are ignored)
+    #   fparams can also be an m x 9 array, one fault per row
+    # disl is the dislocation: strike-slip, dip-slip, opening
+    #   (or an m x 3 array of them, giving an m x n array of LOS displacements)
+
+    UX, UY, UZ = shear_fault_enu(fparams, eparams, data[:,0], data[:,1], disl)
+
+    ULOS = np.multiply(UX,data[:,3]) + np.multiply(UY,data[:,4]) + np.multiply(UZ,data[:,5])
+
+    return ULOS
+
+def shear_fault_enu(fparams, eparams, x, y, disl):
+    "East, north and up displacements for the geometry of an Okada rectangular fault and a given dislocation"
+
+    # fparams, eparams and disl are as for shear_fault_los
+    # x and y are arrays of observation point coordinates, in meters (any shape that broadcasts)
+    # returns arrays of x, y and z displacements
+
+    # fault parameters - as columns, so that a batch of faults broadcasts against the data
+    fparams = np.asarray(fparams, dtype=float)
+    fparams = np.moveaxis(fparams, -1, 0)[..., None]
+    strike = fparams[0]
+    dip = fparams[1]
     xs = fparams[4]
     ys = fparams[5]
     as_length = fparams[6]
-    dd_width = (fparams[8]-fparams[7])/sin(radians(dip))
+    dd_width = (fparams[8]-fparams[7])/np.sin(np.radians(dip))
     cd_depth = (fparams[7]+fparams[8])/2
     
     # elastic parameters    
@@ -44,50 +275,32 @@ def rect_shear_fault(fparams, eparams, data):
     alpha = (lmda + mu) / (lmda + 2 * mu) # elastic constant used by Okada
 
     # calculate centroid coordinates
-    rc = cd_depth/tan(radians(dip))  # radial surface distance from (xs,ys) to centroid
-    rcx = rc*sin(radians(strike+90)) # coordinate shift in x from xs to centroid 
-    rcy = rc*cos(radians(strike+90)) # coordinate shift in y from ys to centroid
+    rc = cd_depth/np.tan(np.radians(dip))  # radial surface distance from (xs,ys) to centroid
+    rcx = rc*np.sin(np.radians(strike+90)) # coordinate shift in x from xs to centroid
+    rcy = rc*np.cos(np.radians(strike+90)) # coordinate shift in y from ys to centroid
     xc = xs+rcx  # x coordinate of centroid
     yc = ys+rcy  # y coordinate of centroid
 
-    # make a rotation matrix to account for strike
-    R=np.array([[cos(radians(strike-90)), -sin(radians(strike-90))], 
-                [sin(radians(strike-90)), cos(radians(strike-90))]])
+    # shift and rotate all the coordinates into Okada geometry in one go, using the rotation matrix
+    #   R = [[cos(strike-90), -sin(strike-90)], [sin(strike-90), cos(strike-90)]]
+    Px = x-xc   # observation points wrt centroid in map coordinates
+    Py = y-yc
+    Qx = np.cos(np.radians(strike-90))*Px - np.sin(np.radians(strike-90))*Py   # rotated into Okada geometry
+    Qy = np.sin(np.radians(strike-90))*Px + np.cos(np.radians(strike-90))*Py
 
-    # convert slip and rake to strike-slip and dip-slip
-    ss=slip*cos(radians(rake))
-    ds=slip*sin(radians(rake))
+    # run the vectorised Okada function on the rotated coordinates
+    u = dc3d_surface(alpha, Qx, Qy,
+                     cd_depth, dip,
+                     [-as_length/2, as_length/2],
+                     [-dd_width/2, dd_width/2],
+                     disl)
 
-    # how many data points are we dealing with?
-    n = len(data)
-    
-    UX = np.zeros(n)
-    UY = np.zeros(n)
-    UZ = np.zeros(n)
+    # here u[0] is strike-parallel displacement and u[1] is strike-normal displacement
+    UX = u[0]*np.sin(np.radians(strike))-u[1]*np.cos(np.radians(strike))   # x displacement
+    UY = u[0]*np.cos(np.radians(strike))-u[1]*np.sin(np.radians(strike))   # y displacement
+    UZ = u[2]   # z displacement
 
-    for i in range(n):
-    
-        # shift and rotate the coordinates into Okada geometry
-        P=np.array([[data[i,0]-xc],[data[i,1]-yc]]); # observation point wrt centroid in map coordinates
-        Q=R.dot(P)                         # observation point rotated into Okada geometry
-            
-        # run the Okada dc3d function on the rotated coordinates   
-        success, u, grad_u = dc3dwrapper(alpha,
-                                            [Q[0], Q[1], 0],
-                                            cd_depth, dip,
-                                            [-as_length/2, as_length/2], 
-                                            [-dd_width/2, dd_width/2],
-                                            [ss, ds, 0.0])
-        assert(success == 0)
-        
-        # here u[0] is strike-parallel displacement and u[1] is strike-normal displacement
-        UX[i] = u[0]*sin(radians(strike))-u[1]*cos(radians(strike))   # x displacement
-        UY[i] = u[0]*cos(radians(strike))-u[1]*sin(radians(strike))   # y displacement
-        UZ[i] = u[2]   # z displacement
-    
-    ULOS = np.multiply(UX,data[:,3]) + np.multiply(UY,data[:,4]) + np.multiply(UZ,data[:,5])
-    
-    return ULOS
+    return UX, UY, UZ
 
 def rect_tensile_fault(fparams, eparams, data): 
     "Attempt at a functional Okada dyke and sill model - wish me luck!"
@@ -122,45 +335,185 @@ def rect_tensile_fault(fparams, eparams, data):
     R=np.array([[cos(radians(strike-90)), -sin(radians(strike-90))], 
                 [sin(radians(strike-90)), cos(radians(strike-90))]])
 
-    # how many data points are we dealing with?
-    n = len(data)
-    
-    UX = np.zeros(n)
-    UY = np.zeros(n)
-    UZ = np.zeros(n)
+    # shift and rotate all the coordinates into Okada geometry in one go
+    P = np.vstack((data[:,0]-xc, data[:,1]-yc))   # observation points wrt centroid in map coordinates
+    Q = R.dot(P)                                    # observation points rotated into Okada geometry
 
-    for i in range(n):
-    
-        # shift and rotate the coordinates into Okada geometry
-        P=np.array([[data[i,0]-xc],[data[i,1]-yc]]); # observation point wrt centroid in map coordinates
-        Q=R.dot(P)                                   # observation point rotated into Okada geometry
-            
-        # run the Okada dc3d function on the rotated coordinates   
-        success, u, grad_u = dc3dwrapper(alpha,
-                                            [Q[0], Q[1], 0],
-                                            zc, dip,
-                                            [-as_length/2, as_length/2], 
-                                            [-dd_width/2, dd_width/2],
-                                            [0.0, 0.0, opening])
-        assert(success == 0)
-        
-        # here u[0] is strike-parallel displacement and u[1] is strike-normal displacement
-        UX[i] = u[0]*sin(radians(strike))-u[1]*cos(radians(strike))   # x displacement
-        UY[i] = u[0]*cos(radians(strike))-u[1]*sin(radians(strike))   # y displacement
-        UZ[i] = u[2]   # z displacement
+    # run the vectorised Okada function on the rotated coordinates
+    u = dc3d_surface(alpha, Q[0], Q[1],
+                     zc, dip,
+                     [-as_length/2, as_length/2],
+                     [-dd_width/2, dd_width/2],
+                     [0.0, 0.0, opening])
+
+    # here u[0] is strike-parallel displacement and u[1] is strike-normal displacement
+    UX = u[0]*sin(radians(strike))-u[1]*cos(radians(strike))   # x displacement
+    UY = u[0]*cos(radians(strike))-u[1]*sin(radians(strike))   # y displacement
+    UZ = u[2]   # z displacement
     
     ULOS = np.multiply(UX,data[:,3]) + np.multiply(UY,data[:,4]) + np.multiply(UZ,data[:,5])
     
     return ULOS
 
 
+def shear_greens(fparams, eparams, data):
+    "Unit-slip LOS Green's vectors for an Okada rectangular fault geometry, cached between calls"
+
+    # same inputs as for rect_shear_fault, but only the geometry is used:
+    #   strike, dip, x, y, length, top, bottom
+    # returns an n x 2 array - LOS displacements for 1 m of strike-slip and 1 m of dip-slip,
+    #   so that rect_shear_fault is shear_greens(...).dot([ss, ds])
+    # the result is cached against the data array itself, so don't modify data in place
+    #   after the first call without calling clear_greens_cache()
+
+    key = (id(data), tuple(float(fparams[i]) for i in (0, 1, 4, 5, 6, 7, 8)),
+           tuple(float(e) for e in eparams))
+
+    global greens_cache_nbytes
+
+    # use the cached vectors if they were computed for this very data array
+    if key in greens_cache:
+        data_ref, G = greens_cache[key]
+        if data_ref() is data:
+            greens_cache.move_to_end(key)
+            return G
+        forget_greens(key)
+
+    G = shear_fault_los(fparams, eparams, data, [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]).T
+
+    # store it (unless it would fill the cache on its own), throwing out the least recently
+    #   used geometries until it fits - the entry is dropped as soon as the data array is freed
+    if G.nbytes <= greens_cache_bytes:
+        data_ref = weakref.ref(data, lambda ref, key=key: forget_greens(key, ref))
+        greens_cache[key] = (data_ref, G)
+        greens_cache_nbytes += G.nbytes
+        while greens_cache_nbytes > greens_cache_bytes:
+            forget_greens(next(iter(greens_cache)))
+
+    return G
+
+def forget_greens(key, data_ref=None):
+    "Drops one geometry from the Green's vector cache (if it's still for data_ref, when given)"
+
+    global greens_cache_nbytes
+
+    entry = greens_cache.get(key)
+    if entry is not None and (data_ref is None or entry[0] is data_ref):
+        del greens_cache[key]
+        greens_cache_nbytes -= entry[1].nbytes
+
+def clear_greens_cache():
+    "Empties the Green's vector cache"
+
+    global greens_cache_nbytes
+
+    greens_cache.clear()
+    greens_cache_nbytes = 0
+
+def rect_shear_fault_batch(fparams_batch, eparams, data):
+    "Okada rectangular fault LOS displacements for a whole batch of fault models at once"
+
+    # fparams_batch is an m x 9 array, each row a set of rect_shear_fault parameters
+    # eparams and data are as for rect_shear_fault
+    # returns an m x n array of LOS displacements, one row per fault model
+
+    fparams_batch = np.atleast_2d(np.asarray(fparams_batch, dtype=float))
+    m = len(fparams_batch)
+
+    # convert slip and rake to strike-slip and dip-slip for every model
+    rake = np.radians(fparams_batch[:,2])
+    slip = fparams_batch[:,3]
+    disl = np.column_stack((slip*np.cos(rake), slip*np.sin(rake), np.zeros(m)))
+
+    # work through the batch in chunks of rows, vectorised over both models and data points
+    rows = max(1, batch_size // max(1, len(data)))
+    ULOS = np.empty((m, len(data)))
+    for i in range(0, m, rows):
+        ULOS[i:i+rows] = shear_fault_los(fparams_batch[i:i+rows], eparams, data, disl[i:i+rows])
+
+    return ULOS
+
+def los_vector(incidence, pointing):
+    "Unit pointing vector for a viewing geometry, the same way the okada notebooks work it out"
+
+    # incidence is the incidence angle in degrees
+    # pointing is the pointing direction, degrees counter-clockwise from north
+    #   (e.g. -260 for Sentinel-1 ascending, -100 for descending)
+    #   both can also be rasters, e.g. the two bands of an ISCE los.rdr.geo file
+    # returns the x, y and z components - the last three columns of a data array
+
+    incidence = np.radians(incidence)
+    pointing = np.radians(pointing)
+
+    return np.array([np.sin(pointing)*np.sin(incidence),
+                     -np.cos(pointing)*np.sin(incidence),
+                     -np.cos(incidence)*np.ones_like(pointing)])
+
+def geotransform_axes(geotransform, shape):
+    "Pixel-centre x and y axes for a north-up raster, from its GDAL geotransform"
+
+    # geotransform is as returned by GetGeoTransform(), in projected meters (e.g. UTM)
+    # shape is the raster size as (rows, columns)
+    # returns the x axis (one value per column) and y axis (one value per row)
+
+    x = geotransform[0] + (np.arange(shape[1])+0.5)*geotransform[1]
+    y = geotransform[3] + (np.arange(shape[0])+0.5)*geotransform[5]
+
+    return x, y
+
+def rect_shear_fault_grid(fparams, eparams, x, y, los=None, tile_rows=None, dtype=float):
+    "Maps of Okada rectangular fault displacements over a regular grid, without any loops over grid nodes"
+
+    # fparams and eparams are as for rect_shear_fault
+    # x and y are the grid axes in meters (e.g. linspace, or from geotransform_axes)
+    # los is an optional line-of-sight vector - either the 3 components of a single vector
+    #   (see los_vector) or 3 rasters of them, one per component
+    # the grid is worked through tile_rows rows at a time, so the temporary arrays stay
+    #   bounded for big grids - by default enough rows for batch_size points
+    # dtype sets the type of the output rasters - np.float32 halves the memory of big maps
+    # returns east, north and up rasters, and the LOS raster (None if no los was given)
+    #   the rasters are len(y) x len(x), rows following y, so they're the transpose of the
+    #   UX[i, j] arrays in the notebooks (no .T needed when plotting)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    shape = (len(y), len(x))
+
+    # convert slip and rake to strike-slip and dip-slip
+    ss=fparams[3]*cos(radians(fparams[2]))
+    ds=fparams[3]*sin(radians(fparams[2]))
+
+    UE = np.empty(shape, dtype=dtype)
+    UN = np.empty(shape, dtype=dtype)
+    UU = np.empty(shape, dtype=dtype)
+
+    if tile_rows is None:
+        tile_rows = max(1, batch_size // max(1, len(x)))
+
+    # each tile is a block of whole rows, with the coordinates broadcast rather than meshed
+    for i in range(0, shape[0], tile_rows):
+        rows = slice(i, i+tile_rows)
+        UE[rows], UN[rows], UU[rows] = shear_fault_enu(fparams, eparams, x[None,:], y[rows,None],
+                                                       [ss, ds, 0.0])
+
+    ULOS = None
+    if los is not None:
+        ULOS = UE*los[0] + UN*los[1] + UU*los[2]
+        ULOS = ULOS.astype(dtype, copy=False)
+
+    return UE, UN, UU, ULOS
+
 def los_penalty_fault(fparams, eparams, data):
     "Calculates total squared penalty for an Okada rectangular fault model, removing the best-fitting zero level shift"
     
     # same inputs as for rect_shear_fault - this time we'll calculate a penalty function from the model
     
-    # calculate the model
-    model_los_disps = rect_shear_fault(fparams, eparams, data)
+    # calculate the model from cached Green's vectors, so that changing only slip or rake
+    #   costs a dot product rather than a new set of Okada evaluations
+    rake = fparams[2]
+    slip = fparams[3]
+    G = shear_greens(fparams, eparams, data)
+    model_los_disps = G.dot([slip*cos(radians(rake)), slip*sin(radians(rake))])
     
     # estimate the mean residual
     zero_shift = np.mean(data[:,2]-model_los_disps)
@@ -170,6 +523,146 @@ def los_penalty_fault(fparams, eparams, data):
     
     return penalty
 
+def los_penalty_fault_batch(fparams_batch, eparams, data):
+    "Calculates total squared penalties for a batch of Okada rectangular fault models, each with its own zero level shift"
+
+    # same inputs as for rect_shear_fault_batch - returns a vector of m penalties
+
+    # calculate the models
+    model_los_disps = rect_shear_fault_batch(fparams_batch, eparams, data)
+
+    # remove the mean residual of each model
+    residuals = data[:,2]-model_los_disps
+    residuals -= np.mean(residuals, axis=1, keepdims=True)
+
+    return np.sum(np.square(residuals), axis=1)
+
+def joint_dataset(datasets, weights=None, offsets=None):
+    "Bundles several datasets together for a joint inversion, merging their observation points"
+
+    # datasets is a list of data arrays, each as for rect_shear_fault - e.g. an ascending and a
+    #   descending track, with GNSS as rows whose LOS vectors are [1,0,0], [0,1,0] and [0,0,1]
+    # weights is a list of weights on each dataset's squared residuals (default all 1)
+    # offsets is a list of flags - whether to remove a best-fitting zero level shift from each
+    #   dataset (default True for all, as in los_penalty_fault - switch it off for GNSS)
+    # returns a dictionary to pass as the data argument of the joint functions:
+    #   'points' holds the unique x, y coordinates, and 'index' maps each dataset's rows onto them
+
+    if weights is None:
+        weights = [1.0]*len(datasets)
+    if offsets is None:
+        offsets = [True]*len(datasets)
+
+    # displacements only need computing once wherever datasets share an observation point
+    points, inverse = np.unique(np.vstack([data[:,0:2] for data in datasets]), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    index = np.split(inverse, np.cumsum([len(data) for data in datasets])[:-1])
+
+    return {'datasets': datasets, 'weights': weights, 'offsets': offsets, 'points': points, 'index': index}
+
+def rect_shear_fault_joint(fparams, eparams, joint):
+    "Okada rectangular fault LOS displacements for every dataset in a joint dataset"
+
+    # fparams and eparams are as for rect_shear_fault, joint is from joint_dataset
+    # returns a list of LOS displacement vectors, one per dataset
+
+    # convert slip and rake to strike-slip and dip-slip
+    ss=fparams[3]*cos(radians(fparams[2]))
+    ds=fparams[3]*sin(radians(fparams[2]))
+
+    # x, y and z displacements at each unique point...
+    UX, UY, UZ = shear_fault_enu(fparams, eparams, joint['points'][:,0], joint['points'][:,1], [ss, ds, 0.0])
+
+    # ...then projected into each dataset's lines of sight
+    return [np.multiply(UX[index],data[:,3]) + np.multiply(UY[index],data[:,4]) + np.multiply(UZ[index],data[:,5])
+            for data, index in zip(joint['datasets'], joint['index'])]
+
+def los_penalty_fault_joint(fparams, eparams, joint):
+    "Calculates the total weighted squared penalty for an Okada rectangular fault model against several datasets"
+
+    # same inputs as for rect_shear_fault_joint - each dataset gets its own zero level shift
+    #   (where its offset flag is set) and its own weight
+
+    penalty = 0.0
+    models = rect_shear_fault_joint(fparams, eparams, joint)
+    for data, model_los_disps, weight, offset in zip(joint['datasets'], models, joint['weights'], joint['offsets']):
+        residuals = data[:,2]-model_los_disps
+        if offset:
+            residuals = residuals-np.mean(residuals)
+        penalty += weight*np.sum(np.square(residuals))
+
+    return penalty
+
+def exponential_covariance(data, sill, length, nugget=0.0):
+    "Exponential data covariance matrix from the distances between observation points"
+
+    # data is as for rect_shear_fault
+    # sill is the variance of correlated noise (m^2) and length its e-folding distance (m)
+    #   - e.g. from fitting an empirical covariogram of the interferogram away from the deformation
+    # nugget is the variance of uncorrelated noise added to the diagonal (m^2)
+    # returns an n x n covariance matrix
+
+    dx = data[:,0,None]-data[None,:,0]
+    dy = data[:,1,None]-data[None,:,1]
+    cov = sill*np.exp(-np.hypot(dx, dy)/length)
+    cov[np.diag_indices_from(cov)] += nugget
+
+    return cov
+
+def whitening_factor(data, cov):
+    "Cholesky factor of a data covariance, with the whitened data, worked out once and cached"
+
+    # data is as for rect_shear_fault, cov is its n x n covariance matrix
+    # returns the lower triangular factor L (cov = L L^T), and L^-1 applied to the
+    #   displacements and to a vector of ones (for the zero level shift)
+    # the result is cached against the data and covariance arrays themselves, so don't modify
+    #   them in place after the first call
+
+    key = (id(data), id(cov))
+
+    if key in cholesky_cache:
+        data_ref, cov_ref, factor = cholesky_cache[key]
+        if data_ref() is data and cov_ref() is cov:
+            cholesky_cache.move_to_end(key)
+            return factor
+        del cholesky_cache[key]
+
+    # the expensive bit - only ever done once per dataset
+    L = cholesky(cov, lower=True)
+    white_data = solve_triangular(L, data[:,2], lower=True)
+    white_ones = solve_triangular(L, np.ones(len(data)), lower=True)
+    factor = (L, white_data, white_ones)
+
+    cholesky_cache[key] = (weakref.ref(data), weakref.ref(cov), factor)
+    while len(cholesky_cache) > cholesky_cache_size:
+        cholesky_cache.popitem(last=False)
+
+    return factor
+
+def los_penalty_fault_cov(fparams, eparams, data, cov):
+    "Calculates the covariance weighted penalty for an Okada rectangular fault model, removing the best-fitting zero level shift"
+
+    # same inputs as for rect_shear_fault, plus cov, the n x n data covariance matrix
+    #   (e.g. from exponential_covariance) - residuals are whitened with its Cholesky factor,
+    #   so the penalty is r^T cov^-1 r
+    # the factor is cached, so each call only costs the forward model and a triangular solve
+
+    L, white_data, white_ones = whitening_factor(data, cov)
+
+    # whiten the model via the cached Green's vectors
+    rake = fparams[2]
+    slip = fparams[3]
+    G = shear_greens(fparams, eparams, data)
+    model_los_disps = G.dot([slip*cos(radians(rake)), slip*sin(radians(rake))])
+    white_residuals = white_data-solve_triangular(L, model_los_disps, lower=True)
+
+    # the generalised least squares estimate of the zero level shift
+    zero_shift = white_ones.dot(white_residuals)/white_ones.dot(white_ones)
+
+    penalty = np.sum(np.square(white_residuals-zero_shift*white_ones))
+
+    return penalty
+
 def los_penalty_tensile(fparams, eparams, data):
     "Calculates total squared penalty for an Okada rectangular tensile dislocation, removing the best-fitting zero level shift"
     
@@ -185,3 +678,1570 @@ def los_penalty_tensile(fparams, eparams, data):
     penalty = np.sum(np.square((data[:,2]-zero_shift)-model_los_disps))
     
     return penalty
+
+def slip_component_bounds(bounds):
+    "Box bounds on strike-slip and dip-slip that enclose the rake and slip bounds of a 9 number Bounds"
+
+    # bounds is a scipy.optimize.Bounds in the same 9 number form as fparams
+    # returns lower and upper bounds on [strike-slip, dip-slip]
+
+    rakes = [bounds.lb[2], bounds.ub[2]]
+    slips = [bounds.lb[3], bounds.ub[3]]
+
+    # an open (or full circle) rake range allows any direction of slip
+    if not np.all(np.isfinite(rakes)) or rakes[1]-rakes[0] >= 360:
+        slip_max = max(abs(slips[0]), abs(slips[1]))
+        return np.array([-slip_max, -slip_max], dtype=float), np.array([slip_max, slip_max], dtype=float)
+
+    # the extremes of slip*cos(rake) and slip*sin(rake) are at the corners of the bounds,
+    #   or wherever the rake range crosses a multiple of 90 degrees
+    rakes += [r for r in range(-360, 361, 90) if rakes[0] < r < rakes[1]]
+    ss = [slip*cos(radians(rake)) for slip in slips if np.isfinite(slip) for rake in rakes]
+    ds = [slip*sin(radians(rake)) for slip in slips if np.isfinite(slip) for rake in rakes]
+
+    # an open slip bound leaves a component unbounded in whichever direction the rakes point it
+    for slip in slips:
+        if not np.isfinite(slip):
+            ss += [np.copysign(np.inf, slip*cos(radians(rake))) for rake in rakes if cos(radians(rake)) != 0]
+            ds += [np.copysign(np.inf, slip*sin(radians(rake))) for rake in rakes if sin(radians(rake)) != 0]
+
+    return np.array([min(ss), min(ds)]), np.array([max(ss), max(ds)])
+
+def linear_fit_fault(gparams, eparams, data, ramp=False, sbounds=None):
+    "Solves for the best-fitting slip and zero level shift (and ramp) for a fault geometry by least squares"
+
+    # gparams is a vector of the nonlinear fault geometry
+    #   7 numbers: strike, dip, x, y, length, top, bottom
+    #      angles in degrees, positions/dimensions in meters
+    # eparams and data are as for rect_shear_fault
+    # if ramp is True, a planar ramp is estimated along with the zero level shift
+    # sbounds is an optional pair of lower and upper bounds on [strike-slip, dip-slip]
+    #   (see slip_component_bounds) - without them a thin fault can soak up huge slip
+    # returns the total squared penalty and the linear parameters:
+    #   strike-slip, dip-slip, zero level shift (at the data centroid), then x and y ramp gradients
+
+    fparams = np.zeros(9)
+    fparams[geometry_index] = gparams
+
+    # design matrix: unit-slip Green's vectors and a column of ones for the zero level shift
+    G = shear_greens(fparams, eparams, data)
+    columns = [G, np.ones((len(data), 1))]
+    if ramp:
+        # ramp coordinates are taken relative to the data centroid to keep things well conditioned
+        columns.append(np.column_stack((data[:,0]-np.mean(data[:,0]), data[:,1]-np.mean(data[:,1]))))
+    A = np.hstack(columns)
+
+    # small least squares problem - 3 or 5 unknowns
+    lparams = np.linalg.lstsq(A, data[:,2], rcond=None)[0]
+
+    # only bother with the bounded solver if the slip has strayed outside its bounds
+    if sbounds is not None and (np.any(lparams[:2] < sbounds[0]) or np.any(lparams[:2] > sbounds[1])):
+        lb = np.full(A.shape[1], -np.inf)
+        ub = np.full(A.shape[1], np.inf)
+        lb[:2] = sbounds[0]
+        ub[:2] = sbounds[1]
+        lparams = lsq_linear(A, data[:,2], bounds=(lb, ub), method='bvls').x
+
+    penalty = np.sum(np.square(data[:,2]-A.dot(lparams)))
+
+    return penalty, lparams
+
+def los_penalty_varpro(gparams, eparams, data, ramp=False, sbounds=None):
+    "Calculates total squared penalty for a fault geometry, with slip and zero level shift solved for exactly"
+
+    # same inputs as for linear_fit_fault - this is the function to hand to the optimizer
+
+    return linear_fit_fault(gparams, eparams, data, ramp, sbounds)[0]
+
+def invert_fault_varpro(fparams_start, eparams, data, bounds=None, ramp=False):
+    "Inverts for an Okada rectangular fault, searching the geometry only and solving for slip at each step"
+
+    # fparams_start is a starting model in the same 9 number form as for rect_shear_fault
+    #   (rake and slip are not needed for the search, and are ignored)
+    # bounds is an optional scipy.optimize.Bounds in the same 9 number form
+    #   (the rake and slip bounds become bounds on the strike-slip and dip-slip solution)
+    # eparams, data and ramp are as for linear_fit_fault
+    # returns the best fitting fparams (with rake and slip filled in), the nuisance parameters
+    #   (zero level shift, plus ramp gradients if asked for) and the scipy results from the search
+
+    gparams_start = np.asarray(fparams_start, dtype=float)[geometry_index]
+
+    # cut the bounds down to the geometry parameters, as the slip is no longer searched over
+    gbounds = None
+    sbounds = None
+    if bounds is not None:
+        gbounds = Bounds(np.asarray(bounds.lb, dtype=float)[geometry_index],
+                         np.asarray(bounds.ub, dtype=float)[geometry_index])
+        sbounds = slip_component_bounds(bounds)
+
+    # run the Powell algorithm minimizer over the 7 geometry parameters only
+    results = minimize(los_penalty_varpro, gparams_start, args=(eparams, data, ramp, sbounds),
+                       method='Powell', bounds=gbounds)
+
+    # recover the slip that goes with the best geometry
+    penalty, lparams = linear_fit_fault(results.x, eparams, data, ramp, sbounds)
+
+    fparams_out = np.zeros(9)
+    fparams_out[geometry_index] = results.x
+    fparams_out[2] = degrees(atan2(lparams[1], lparams[0]))   # rake
+    fparams_out[3] = hypot(lparams[0], lparams[1])            # slip
+
+    return fparams_out, lparams[2:], results
+
+def random_start(fparams_start, fparams_sigma, rng=np.random):
+    "Random starting model, drawn uniformly within two sigma of the starting values"
+
+    # fparams_start and fparams_sigma are the starting guess and its sigma, as in the notebooks
+    # rng is anything with a random method, np.random.RandomState(seed) or np.random.default_rng(seed)
+
+    fparams_start = np.asarray(fparams_start, dtype=float)
+    fparams_restart = fparams_start + np.multiply(((rng.random(len(fparams_start))*4)-2), fparams_sigma)
+
+    # sanity check of depths (make sure bottom depth is greater than top depth)
+    if len(fparams_restart) == 9 and fparams_restart[7] > fparams_restart[8]:
+        fparams_restart[[7, 8]] = fparams_restart[[8, 7]]
+
+    return fparams_restart
+
+def attach_worker_data(shm_name, shape, dtype, counter=None):
+    "Pool initializer - maps the shared data array into a worker process"
+
+    # counter is an optional shared multiprocessing.Value that numbers the workers as they start
+
+    global worker_data, worker_shm, worker_index
+
+    worker_shm = shared_memory.SharedMemory(name=shm_name)
+    worker_data = np.ndarray(shape, dtype=dtype, buffer=worker_shm.buf)
+    worker_data.flags.writeable = False
+
+    if counter is not None:
+        with counter.get_lock():
+            worker_index = counter.value
+            counter.value += 1
+
+@contextmanager
+def worker_pool(data, workers):
+    "Process pool whose workers all map one shared, read-only copy of the data array"
+
+    # use as: with worker_pool(data, workers) as pool: ...
+    #   tasks then read the data from worker_data rather than having it pickled along with them
+
+    # put the data in shared memory once, so the workers map it rather than each task pickling it
+    data = np.ascontiguousarray(data, dtype=float)
+    shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+    try:
+        np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[:] = data
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach_worker_data,
+                                 initargs=(shm.name, data.shape, data.dtype, Value('i', 0))) as pool:
+            yield pool
+    finally:
+        shm.close()
+        shm.unlink()
+
+@contextmanager
+def nullpool():
+    "Stands in for worker_pool when everything runs in this process"
+
+    yield None
+
+def multistart_task(fparams_restart, bounds, eparams, penalty):
+    "Runs one Powell inversion from a given start against the worker's shared data"
+
+    results = minimize(penalty, fparams_restart, args=(eparams, worker_data), method='Powell',
+                       bounds=bounds)
+
+    return results.x, results.fun
+
+def multistart_invert(fparams_start, fparams_sigma, bounds, eparams, data, n_starts=100, workers=None,
+                      penalty=los_penalty_fault, seed=None):
+    "Runs Powell inversions from many random starting models, spread across a pool of processes"
+
+    # fparams_start and fparams_sigma are the starting guess and its sigma (see random_start)
+    # bounds is a scipy.optimize.Bounds, eparams and data are as for rect_shear_fault
+    # n_starts is the number of random restarts, workers the number of processes
+    #   (None uses every core, 1 runs everything in this process)
+    # penalty is the function to minimize - los_penalty_fault or los_penalty_tensile
+    # seed makes the random starting models repeatable
+    # returns the best fparams, its penalty, and an n_starts x (len(fparams)+1) array of
+    #   all the local minima found (fparams then penalty), sorted best first
+
+    rng = np.random.RandomState(seed)
+    starts = [random_start(fparams_start, fparams_sigma, rng) for i in range(n_starts)]
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers == 1:
+        solutions = [minimize(penalty, start, args=(eparams, data), method='Powell', bounds=bounds)
+                     for start in starts]
+        solutions = [(results.x, results.fun) for results in solutions]
+    else:
+        with worker_pool(data, workers) as pool:
+            futures = [pool.submit(multistart_task, start, bounds, eparams, penalty) for start in starts]
+            solutions = [future.result() for future in futures]
+
+    minima = np.array([np.append(x, fun) for x, fun in solutions])
+    minima = minima[np.argsort(minima[:,-1])]
+
+    return minima[0,:-1], minima[0,-1], minima
+
+def realization_fit(data, rows, disp, fparams_start, bounds, eparams, penalty):
+    "Runs one Powell inversion against a resampled or perturbed copy of the data"
+
+    # rows picks (and repeats) rows of data, or is None for all of them
+    # disp replaces the displacements, or is None to keep them
+
+    data = np.array(data if rows is None else data[rows])
+    if disp is not None:
+        data[:,2] = disp
+
+    results = minimize(penalty, fparams_start, args=(eparams, data), method='Powell', bounds=bounds)
+
+    return results.x, results.fun
+
+def bootstrap_task(rows, disp, fparams_start, bounds, eparams, penalty):
+    "Runs realization_fit against the worker's shared data"
+
+    return realization_fit(worker_data, rows, disp, fparams_start, bounds, eparams, penalty)
+
+def bootstrap_invert(fparams_best, bounds, eparams, data, n_realizations=500, method='residuals', cov=None,
+                     workers=None, penalty=los_penalty_fault, model=rect_shear_fault, seed=None):
+    "Parameter distributions from re-inverting many resampled or noisy versions of the data"
+
+    # fparams_best is the best-fitting model (e.g. from minimize or multistart_invert) - every
+    #   inversion starts from it, so each only has to find its way to a nearby minimum
+    # bounds is a scipy.optimize.Bounds, eparams and data are as for rect_shear_fault
+    # method is how each realization of the data is made:
+    #   'residuals' - the best-fitting model plus residuals drawn with replacement
+    #   'points'    - data points drawn with replacement
+    #   'jackknife' - the data with one of n_realizations groups of points left out (each point
+    #                 left out in turn if n_realizations is at least the number of points)
+    #   'noise'     - the best-fitting model plus noise drawn from the covariance matrix cov
+    #                 (e.g. from exponential_covariance)
+    # workers is the number of processes (None uses every core, 1 runs everything in this process)
+    # penalty is the function to minimize and model the matching forward model - rect_shear_fault
+    #   for los_penalty_fault, rect_tensile_fault for los_penalty_tensile (don't use a MemoPenalty
+    #   here - its keys don't know the data have changed)
+    # seed makes the realizations repeatable
+    # returns an n_realizations x len(fparams) array of parameters and a vector of their penalties
+    #   - the spread of the jackknife estimates has to be scaled up to give standard errors: for
+    #   g groups that is (g-1)/sqrt(g) times np.std(..., ddof=1), or sqrt(g-1) times np.std with
+    #   its default ddof=0. The others can be used as they are
+
+    if method == 'noise' and cov is None:
+        raise ValueError("method='noise' needs a data covariance matrix, cov")
+
+    rng = np.random.RandomState(seed)
+    fparams_best = np.asarray(fparams_best, dtype=float)
+    n = len(data)
+
+    # best-fitting model, with its zero level shift, for the methods that perturb it
+    model_los_disps = model(fparams_best, eparams, data)
+    model_los_disps = model_los_disps + np.mean(data[:,2]-model_los_disps)
+
+    if method == 'residuals':
+        residuals = data[:,2]-model_los_disps
+        realizations = [(None, model_los_disps + residuals[rng.randint(n, size=n)])
+                        for i in range(n_realizations)]
+    elif method == 'points':
+        realizations = [(rng.randint(n, size=n), None) for i in range(n_realizations)]
+    elif method == 'jackknife':
+        groups = np.array_split(rng.permutation(n), min(n_realizations, n))
+        realizations = [(np.setdiff1d(np.arange(n), group), None) for group in groups]
+    elif method == 'noise':
+        L = cholesky(cov, lower=True)
+        realizations = [(None, model_los_disps + L.dot(rng.standard_normal(n)))
+                        for i in range(n_realizations)]
+    else:
+        raise ValueError("method should be 'residuals', 'points', 'jackknife' or 'noise'")
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers == 1:
+        solutions = [realization_fit(data, rows, disp, fparams_best, bounds, eparams, penalty)
+                     for rows, disp in realizations]
+    else:
+        with worker_pool(data, workers) as pool:
+            futures = [pool.submit(bootstrap_task, rows, disp, fparams_best, bounds, eparams, penalty)
+                       for rows, disp in realizations]
+            solutions = [future.result() for future in futures]
+
+    return np.array([x for x, fun in solutions]), np.array([fun for x, fun in solutions])
+
+def evolve_invert(bounds, eparams, data, fparams_start=None, popsize=None, generations=1000, mutation=(0.5, 1.0),
+                  recombination=0.9, tol=1e-6, penalty=los_penalty_fault_batch, seed=None):
+    "Global search for the best model by differential evolution, scoring each generation in one batch"
+
+    # bounds is a scipy.optimize.Bounds (it has to be finite - it is the search space),
+    #   eparams and data are as for rect_shear_fault
+    # fparams_start is an optional starting guess, put into the first generation
+    # popsize is the number of models per generation (default ten per parameter)
+    # generations is the most generations to run
+    # mutation is the range of the difference weight, drawn afresh each generation, and
+    #   recombination the chance of each parameter coming from the mutant (DE/current-to-best/1/bin)
+    # the search stops once the spread of penalties in the population is below tol times their mean
+    # penalty is a batched penalty - los_penalty_fault_batch, or any other taking an m x k array of
+    #   models, e.g. los_penalty_mogi
+    # seed makes the search repeatable
+    # returns the best fparams, its penalty, and the number of models evaluated
+    # models keep bottom deeper than top, as in random_start
+
+    rng = np.random.RandomState(seed)
+    lb = np.asarray(bounds.lb, dtype=float)
+    ub = np.asarray(bounds.ub, dtype=float)
+    k = len(lb)
+    if popsize is None:
+        popsize = 10*k
+
+    def sanity(population):
+        # sanity check of depths (make sure bottom depth is greater than top depth)
+        if k == 9:
+            swap = population[:,7] > population[:,8]
+            population[swap,7:9] = population[swap,8:6:-1]
+        return population
+
+    # first generation spread evenly through the bounds (a Latin hypercube)
+    strata = np.argsort(rng.random_sample((popsize, k)), axis=0)
+    population = lb + (strata + rng.random_sample((popsize, k)))/popsize*(ub-lb)
+    if fparams_start is not None:
+        population[0] = fparams_start
+    population = sanity(population)
+    penalties = penalty(population, eparams, data)
+    evaluations = popsize
+
+    for generation in range(generations):
+        best = np.argmin(penalties)
+        if np.std(penalties) <= tol*abs(np.mean(penalties)):
+            break
+
+        # mutants from two other random members, pulled towards the best
+        r = np.array([rng.choice(np.delete(np.arange(popsize), i), 2, replace=False) for i in range(popsize)])
+        f = rng.uniform(*mutation)
+        mutants = population + f*(population[best]-population) + f*(population[r[:,0]]-population[r[:,1]])
+
+        # crossover, always taking at least one parameter from the mutant
+        cross = rng.random_sample((popsize, k)) < recombination
+        cross[np.arange(popsize), rng.randint(k, size=popsize)] = True
+        trials = np.where(cross, mutants, population)
+
+        # anything outside the bounds bounces back to somewhere between its parent and the bound
+        low = trials < lb
+        high = trials > ub
+        trials[low] = (population + rng.random_sample((popsize, k))*(lb-population))[low]
+        trials[high] = (population + rng.random_sample((popsize, k))*(ub-population))[high]
+        trials = sanity(trials)
+
+        # the whole generation in one call to the batched penalty
+        trial_penalties = penalty(trials, eparams, data)
+        evaluations += popsize
+
+        better = trial_penalties <= penalties
+        population[better] = trials[better]
+        penalties[better] = trial_penalties[better]
+
+    best = np.argmin(penalties)
+
+    return population[best], penalties[best], evaluations
+
+def log_posterior_fault_batch(fparams_batch, eparams, data, bounds, sigma):
+    "Log posterior for a batch of Okada rectangular fault models - Gaussian data errors, flat priors within bounds"
+
+    # fparams_batch, eparams and data are as for rect_shear_fault_batch
+    # bounds is a scipy.optimize.Bounds giving the limits of the flat priors
+    # sigma is the standard deviation of the LOS data errors, in meters
+    # returns a vector of m log posterior values (up to a constant), -inf outside the priors
+
+    fparams_batch = np.atleast_2d(np.asarray(fparams_batch, dtype=float))
+    log_post = np.full(len(fparams_batch), -np.inf)
+
+    # only bother modeling the faults that are inside the bounds and have bottom below top
+    inside = np.all((fparams_batch >= bounds.lb) & (fparams_batch <= bounds.ub), axis=1)
+    inside &= fparams_batch[:,8] > fparams_batch[:,7]
+    if np.any(inside):
+        log_post[inside] = -0.5*los_penalty_fault_batch(fparams_batch[inside], eparams, data)/sigma**2
+
+    return log_post
+
+def log_posterior_task(fparams_batch, eparams, bounds, sigma):
+    "Evaluates the log posterior of some of the walkers against the worker's shared data"
+
+    return log_posterior_fault_batch(fparams_batch, eparams, worker_data, bounds, sigma)
+
+def mcmc_sample(fparams_start, fparams_sigma, bounds, eparams, data, sigma, n_walkers=64, n_steps=1000,
+                workers=1, checkpoint=None, checkpoint_every=100, seed=None, stretch=2.0):
+    "Samples the posterior of an Okada rectangular fault with an affine-invariant ensemble of walkers"
+
+    # fparams_start and fparams_sigma set up the starting walkers (see random_start)
+    # bounds, eparams, data and sigma are as for log_posterior_fault_batch
+    # n_walkers must be even - each step moves half the ensemble at a time using the other half
+    #   (Goodman & Weare 2010 stretch moves), and each half goes through one batched forward model
+    # workers > 1 splits each half-ensemble across a pool of processes
+    # checkpoint is an optional .npz file name - the sampler state is saved there every
+    #   checkpoint_every steps, and if the file exists already the run carries on from it
+    # stretch is the stretch move scale parameter (2 is the usual choice)
+    # returns the chain (n_steps x n_walkers x 9), its log posterior values (n_steps x n_walkers),
+    #   the acceptance rate and the number of forward models per second
+
+    if n_walkers % 2:
+        raise ValueError('n_walkers must be even')
+
+    rng = np.random.RandomState(seed)
+    ndim = len(fparams_start)
+    chain = np.zeros((n_steps, n_walkers, ndim))
+    log_posts = np.zeros((n_steps, n_walkers))
+    accepted = 0
+    step = 0
+
+    def evaluate(fparams_batch):
+        # split the batch over the pool if there is one
+        if pool is None:
+            return log_posterior_fault_batch(fparams_batch, eparams, data, bounds, sigma)
+        futures = [pool.submit(log_posterior_task, chunk, eparams, bounds, sigma)
+                   for chunk in np.array_split(fparams_batch, workers) if len(chunk)]
+        return np.concatenate([future.result() for future in futures])
+
+    with (worker_pool(data, workers) if workers > 1 else nullpool()) as pool:
+
+        if checkpoint is not None and os.path.exists(checkpoint):
+            # pick up where the last run left off
+            state = np.load(checkpoint, allow_pickle=False)
+            step = int(state['step'])
+            if step > n_steps:
+                raise ValueError('checkpoint %s is already at step %d, past n_steps=%d'
+                                 % (checkpoint, step, n_steps))
+            chain[:step] = state['chain'][:step]
+            log_posts[:step] = state['log_posts'][:step]
+            accepted = int(state['accepted'])
+            walkers = state['walkers']
+            log_post = state['log_post']
+            rng.set_state(('MT19937', state['rng_keys'], int(state['rng_pos']),
+                           int(state['rng_has_gauss']), float(state['rng_gauss'])))
+        else:
+            # starting walkers, redrawing any that land outside the priors
+            walkers = np.array([random_start(fparams_start, fparams_sigma, rng) for i in range(n_walkers)])
+            log_post = evaluate(walkers)
+            while not np.all(np.isfinite(log_post)):
+                bad = ~np.isfinite(log_post)
+                walkers[bad] = [random_start(fparams_start, fparams_sigma, rng) for i in range(np.sum(bad))]
+                log_post[bad] = evaluate(walkers[bad])
+
+        half = n_walkers//2
+        n_evals = 0
+        start_time = time.time()
+
+        while step < n_steps:
+            for active, others in ((slice(0, half), slice(half, None)), (slice(half, None), slice(0, half))):
+
+                # stretch moves for the active half towards randomly chosen walkers in the other half
+                z = ((stretch-1)*rng.random_sample(half)+1)**2/stretch
+                partners = walkers[others][rng.randint(half, size=half)]
+                proposals = partners + z[:,None]*(walkers[active]-partners)
+
+                new_log_post = evaluate(proposals)
+                n_evals += half
+
+                accept = np.log(rng.random_sample(half)) < (ndim-1)*np.log(z) + new_log_post - log_post[active]
+                walkers[active][accept] = proposals[accept]
+                log_post[active][accept] = new_log_post[accept]
+                accepted += np.sum(accept)
+
+            chain[step] = walkers
+            log_posts[step] = log_post
+            step += 1
+
+            if checkpoint is not None and (step % checkpoint_every == 0 or step == n_steps):
+                rng_state = rng.get_state()
+                with open(checkpoint+'.tmp', 'wb') as f:
+                    np.savez(f, step=step, chain=chain[:step], log_posts=log_posts[:step],
+                             accepted=accepted, walkers=walkers, log_post=log_post,
+                             rng_keys=rng_state[1], rng_pos=rng_state[2],
+                             rng_has_gauss=rng_state[3], rng_gauss=rng_state[4])
+                os.replace(checkpoint+'.tmp', checkpoint)
+
+    elapsed = time.time()-start_time
+    acceptance = accepted/(n_steps*n_walkers)
+    evals_per_sec = n_evals/elapsed if elapsed > 0 else np.inf
+
+    return chain, log_posts, acceptance, evals_per_sec
+
+def mesh_fault(fparams, n_strike, n_dip):
+    "Splits an Okada rectangular fault into n_strike x n_dip patches"
+
+    # fparams is as for rect_shear_fault (rake and slip are copied to every patch)
+    # returns an (n_strike*n_dip) x 9 array of patch parameters in the same form, ordered
+    #   along strike first, then down dip - so patch j*n_strike+i is the i'th along strike
+    #   in the j'th row from the top
+    # every patch shares the fault's surface trace, so only its x, y, length and depths change
+
+    strike = fparams[0]
+    as_length = fparams[6]
+    depths = np.linspace(fparams[7], fparams[8], n_dip+1)
+    offsets = (np.arange(n_strike)+0.5)*as_length/n_strike - as_length/2   # along strike from the centre
+
+    patches = np.tile(np.asarray(fparams, dtype=float), (n_strike*n_dip, 1))
+    patches[:,4] += np.tile(offsets*sin(radians(strike)), n_dip)
+    patches[:,5] += np.tile(offsets*cos(radians(strike)), n_dip)
+    patches[:,6] = as_length/n_strike
+    patches[:,7] = np.repeat(depths[:-1], n_strike)
+    patches[:,8] = np.repeat(depths[1:], n_strike)
+
+    return patches
+
+def distributed_greens(patches, eparams, data):
+    "LOS Green's matrix for a set of fault patches, using the batched forward model"
+
+    # patches is from mesh_fault, eparams and data are as for rect_shear_fault
+    # returns an n x 2p matrix - unit strike-slip on each patch in the first p columns,
+    #   unit dip-slip on each patch in the last p columns
+
+    p = len(patches)
+    disl = np.zeros((2*p, 3))
+    disl[:p,0] = 1.0
+    disl[p:,1] = 1.0
+    fparams_batch = np.vstack((patches, patches))
+
+    # work through the patches in chunks of rows, as in rect_shear_fault_batch
+    rows = max(1, batch_size // max(1, len(data)))
+    G = np.empty((2*p, len(data)))
+    for i in range(0, 2*p, rows):
+        G[i:i+rows] = shear_fault_los(fparams_batch[i:i+rows], eparams, data, disl[i:i+rows])
+
+    return G.T
+
+def laplacian_operator(fparams, n_strike, n_dip):
+    "Sparse finite difference Laplacian for slip on a meshed fault"
+
+    # fparams, n_strike and n_dip are as for mesh_fault
+    # returns a sparse 2p x 2p matrix acting on the slip vector from distributed_greens
+    #   (strike-slip and dip-slip are smoothed separately)
+    # slip beyond the edges of the fault is taken to be zero, which pulls it down at the edges
+
+    dx = fparams[6]/n_strike                                    # patch length
+    dy = (fparams[8]-fparams[7])/sin(radians(fparams[1]))/n_dip  # patch width
+
+    d2x = sparse.diags([1.0, -2.0, 1.0], [-1, 0, 1], shape=(n_strike, n_strike))/dx**2
+    d2y = sparse.diags([1.0, -2.0, 1.0], [-1, 0, 1], shape=(n_dip, n_dip))/dy**2
+    lap = sparse.kron(sparse.identity(n_dip), d2x) + sparse.kron(d2y, sparse.identity(n_strike))
+
+    return sparse.block_diag((lap, lap), format='csr')
+
+def distributed_slip_system(G, data, cov=None):
+    "Data equations for invert_distributed_slip, whitened with the data covariance if there is one"
+
+    # G, data and cov are as for invert_distributed_slip
+    # returns the design matrix (G with a column of ones for the zero level shift) and the
+    #   displacements, both with L^-1 applied when cov is given
+
+    if cov is None:
+        return np.hstack((G, np.ones((len(data), 1)))), data[:,2]
+
+    L, white_data, white_ones = whitening_factor(data, cov)
+    A = np.hstack((solve_triangular(L, G, lower=True), white_ones[:,None]))
+
+    return A, white_data
+
+def solve_distributed_slip(A, d, smoothing_op, smoothing, ss_bounds=None, ds_bounds=None):
+    "Smoothed sparse least squares solve of a system from distributed_slip_system"
+
+    # A and d are from distributed_slip_system, the rest is as for invert_distributed_slip
+    # returns the same as invert_distributed_slip
+
+    # stack the data equations on top of the smoothing equations without ever forming the
+    #   combined matrix - the zero level shift (last unknown) is left unsmoothed
+    n, m = A.shape
+    D = sparse.hstack((smoothing*smoothing_op, sparse.csr_matrix((m-1, 1))), format='csr')
+    op = LinearOperator((n+m-1, m), dtype=float,
+                        matvec=lambda x: np.concatenate((A.dot(x), D.dot(x))),
+                        rmatvec=lambda y: A.T.dot(y[:n]) + D.T.dot(y[n:]))
+    rhs = np.concatenate((d, np.zeros(m-1)))
+
+    if ss_bounds is None and ds_bounds is None:
+        x = lsmr(op, rhs, atol=1e-12, btol=1e-12, maxiter=10*m)[0]
+    else:
+        p = (m-1)//2
+        lb = np.full(m, -np.inf)
+        ub = np.full(m, np.inf)
+        if ss_bounds is not None:
+            lb[:p], ub[:p] = ss_bounds
+        if ds_bounds is not None:
+            lb[p:2*p], ub[p:2*p] = ds_bounds
+        x = lsq_linear(op, rhs, bounds=(lb, ub), lsq_solver='lsmr', lsmr_tol='auto').x
+
+    misfit = np.linalg.norm(d-A.dot(x))
+    roughness = np.linalg.norm(smoothing_op.dot(x[:-1]))
+
+    return x[:-1].reshape(2, -1).T, x[-1], misfit, roughness
+
+def invert_distributed_slip(G, data, smoothing_op, smoothing, ss_bounds=None, ds_bounds=None, cov=None):
+    "Solves for smoothed slip on a meshed fault, with a zero level shift, by sparse least squares"
+
+    # G is from distributed_greens and data is as for rect_shear_fault
+    # smoothing_op is from laplacian_operator, and smoothing is the weight on it
+    # ss_bounds and ds_bounds are optional (lower, upper) bounds on strike-slip and dip-slip -
+    #   e.g. (0, np.inf) to make dip-slip non-negative
+    # cov is an optional data covariance matrix to whiten the residuals with (see whitening_factor)
+    # returns a p x 2 array of strike-slip and dip-slip, the zero level shift, and the misfit
+    #   and roughness norms (for an L-curve)
+
+    A, d = distributed_slip_system(G, data, cov)
+
+    return solve_distributed_slip(A, d, smoothing_op, smoothing, ss_bounds, ds_bounds)
+
+def lcurve(G, data, smoothing_op, smoothings, ss_bounds=None, ds_bounds=None, cov=None):
+    "Runs invert_distributed_slip over a range of smoothing weights, reusing the one Green's matrix"
+
+    # same inputs as for invert_distributed_slip, but with a list of smoothing weights
+    # returns arrays of the misfit and roughness norms, and a list of the slip solutions
+    # G is whitened once up front, not once per smoothing weight
+
+    A, d = distributed_slip_system(G, data, cov)
+
+    misfits = []
+    roughnesses = []
+    slips = []
+    for smoothing in smoothings:
+        slip, zero_shift, misfit, roughness = solve_distributed_slip(A, d, smoothing_op, smoothing,
+                                                                     ss_bounds, ds_bounds)
+        misfits.append(misfit)
+        roughnesses.append(roughness)
+        slips.append(slip)
+
+    return np.array(misfits), np.array(roughnesses), slips
+
+def los_residuals_fault(fparams, eparams, data):
+    "Residual vector for an Okada rectangular fault model, with the best-fitting zero level shift removed"
+
+    # same inputs as for rect_shear_fault - the sum of squares of this is los_penalty_fault
+
+    rake = fparams[2]
+    slip = fparams[3]
+    G = shear_greens(fparams, eparams, data)
+    residuals = data[:,2]-G.dot([slip*cos(radians(rake)), slip*sin(radians(rake))])
+
+    return residuals-np.mean(residuals)
+
+def los_jacobian_fault(fparams, eparams, data):
+    "Jacobian of los_residuals_fault, from one batched forward model"
+
+    # same inputs as for rect_shear_fault
+    # returns an n x 9 matrix of derivatives of the residuals with respect to each fault parameter
+    # rake and slip derivatives are exact (from the Green's vectors); the geometry derivatives are
+    #   forward differences, with all 7 perturbed models computed in a single batch
+
+    fparams = np.asarray(fparams, dtype=float)
+    rake = radians(fparams[2])
+    slip = fparams[3]
+    disl = [slip*cos(rake), slip*sin(rake), 0.0]
+
+    # the unperturbed model and one perturbed model per geometry parameter
+    steps = 1e-6*(np.abs(fparams)+jacobian_scale)
+    fparams_batch = np.tile(fparams, (len(geometry_index)+1, 1))
+    fparams_batch[np.arange(1, len(geometry_index)+1), geometry_index] += steps[geometry_index]
+    models = shear_fault_los(fparams_batch, eparams, data, disl)
+
+    dmodel = np.zeros((len(data), 9))
+    dmodel[:,geometry_index] = ((models[1:]-models[0])/steps[geometry_index,None]).T
+
+    G = shear_greens(fparams, eparams, data)
+    dmodel[:,2] = G.dot([-slip*sin(rake), slip*cos(rake)])*pi/180   # per degree of rake
+    dmodel[:,3] = G.dot([cos(rake), sin(rake)])
+
+    # the zero level shift takes out the mean of every column
+    return -(dmodel-np.mean(dmodel, axis=0))
+
+def invert_fault_lsq(fparams_start, eparams, data, bounds=None, sigma=None):
+    "Inverts for an Okada rectangular fault by nonlinear least squares on the residual vector"
+
+    # fparams_start, eparams and data are as for rect_shear_fault
+    # bounds is an optional scipy.optimize.Bounds - without it this is Levenberg-Marquardt,
+    #   with it scipy's trust region reflective method (Levenberg-Marquardt can't take bounds)
+    # sigma is the standard deviation of the data errors - if not given, it's estimated from
+    #   the final misfit
+    # returns the best fitting fparams, their 9 x 9 covariance matrix (from the final Jacobian,
+    #   so at no extra cost) and the scipy results
+
+    if bounds is None:
+        results = least_squares(los_residuals_fault, fparams_start, jac=los_jacobian_fault,
+                                args=(eparams, data), method='lm')
+    else:
+        results = least_squares(los_residuals_fault, fparams_start, jac=los_jacobian_fault,
+                                args=(eparams, data), method='trf', bounds=(bounds.lb, bounds.ub))
+
+    # one degree of freedom goes on the zero level shift
+    if sigma is None:
+        variance = 2*results.cost/max(1, len(data)-len(fparams_start)-1)
+    else:
+        variance = sigma**2
+    covariance = variance*np.linalg.pinv(results.jac.T.dot(results.jac))
+
+    return results.x, covariance, results
+
+def dc3d0_surface(alpha, x, y, depth, dip, pot):
+    "Vectorised stand-in for dc3d0wrapper (point source), for observation points at the surface (z=0)"
+
+    # alpha, x, y, depth and dip are as for dc3d_surface
+    # pot is the potency: strike-slip, dip-slip, tensile and inflation
+    #   (each can be an m x 1 array for a batch of sources)
+    # returns arrays of x, y and z displacements in Okada geometry - the Okada (1985) point source
+
+    sd = np.sin(np.radians(dip))
+    cd = np.cos(np.radians(dip))
+    mr = 1/alpha - 1   # mu/(lambda+mu)
+
+    d = depth
+    p = y*cd + d*sd
+    q = y*sd - d*cd
+    r = np.sqrt(x*x + y*y + d*d)
+    r3 = r**3
+    r5 = r**5
+    rd = r + d
+
+    # the I0 terms of Okada (1985)
+    i1 = mr*y*(1/(r*rd**2) - x*x*(3*r+d)/(r3*rd**3))
+    i2 = mr*x*(1/(r*rd**2) - y*y*(3*r+d)/(r3*rd**3))
+    i3 = mr*x/r3 - i2
+    i4 = -mr*x*y*(2*r+d)/(r3*rd**2)
+    i5 = mr*(1/(r*rd) - x*x*(2*r+d)/(r3*rd**2))
+
+    fss = [3*x*x*q/r5 + i1*sd, 3*x*y*q/r5 + i2*sd, 3*x*d*q/r5 + i4*sd]
+    fds = [3*x*p*q/r5 - i3*sd*cd, 3*y*p*q/r5 - i1*sd*cd, 3*d*p*q/r5 - i5*sd*cd]
+    fts = [3*x*q*q/r5 - i3*sd*sd, 3*y*q*q/r5 - i1*sd*sd, 3*d*q*q/r5 - i5*sd*sd]
+    fin = [mr*x/r3, mr*y/r3, mr*d/r3]   # a centre of dilatation
+
+    return [(-pot[0]*fss[i] - pot[1]*fds[i] + pot[2]*fts[i] + pot[3]*fin[i])/(2*pi) for i in range(3)]
+
+def poisson_ratio(eparams):
+    "Poisson's ratio from the Lame parameters"
+
+    return eparams[0]/(2*(eparams[0]+eparams[1]))
+
+def shifted_penalty(model_los_disps, data):
+    "Total squared penalty for a model (or a batch of models, one per row), removing the best-fitting zero level shift"
+
+    residuals = data[:,2]-model_los_disps
+    residuals = residuals-np.mean(residuals, axis=-1, keepdims=True)
+
+    return np.sum(np.square(residuals), axis=-1)
+
+def point_dislocation(fparams, eparams, data):
+    "Okada point dislocation model - the dc3d0 counterpart of rect_shear_fault"
+
+    # fparams is a vector of point source parameters
+    #   9 numbers: strike, dip, x, y, depth, then strike-slip, dip-slip, tensile and inflation potencies
+    #      angles in degrees, positions in meters, potencies in m^3 (moment/mu for the slip ones)
+    #   or an m x 9 array of them, giving an m x n array of LOS displacements
+    # eparams and data are as for rect_shear_fault
+
+    # source parameters - as columns, so that a batch of sources broadcasts against the data
+    fparams = np.moveaxis(np.asarray(fparams, dtype=float), -1, 0)[..., None]
+    strike = fparams[0]
+    dip = fparams[1]
+    xc = fparams[2]
+    yc = fparams[3]
+    zc = fparams[4]
+
+    # elastic parameters
+    lmda = eparams[0]
+    mu = eparams[1]
+    alpha = (lmda + mu) / (lmda + 2 * mu) # elastic constant used by Okada
+
+    # shift and rotate the coordinates into Okada geometry, as in shear_fault_enu
+    Px = data[:,0]-xc
+    Py = data[:,1]-yc
+    Qx = np.cos(np.radians(strike-90))*Px - np.sin(np.radians(strike-90))*Py
+    Qy = np.sin(np.radians(strike-90))*Px + np.cos(np.radians(strike-90))*Py
+
+    u = dc3d0_surface(alpha, Qx, Qy, zc, dip, fparams[5:9])
+
+    # here u[0] is strike-parallel displacement and u[1] is strike-normal displacement
+    UX = u[0]*np.sin(np.radians(strike))-u[1]*np.cos(np.radians(strike))   # x displacement
+    UY = u[0]*np.cos(np.radians(strike))-u[1]*np.sin(np.radians(strike))   # y displacement
+    UZ = u[2]   # z displacement
+
+    ULOS = np.multiply(UX,data[:,3]) + np.multiply(UY,data[:,4]) + np.multiply(UZ,data[:,5])
+
+    return ULOS
+
+def mogi_source(fparams, eparams, data):
+    "Mogi point pressure source model"
+
+    # fparams is a vector of source parameters
+    #   4 numbers: x, y, depth, volume change
+    #      positions in meters, volume change in m^3
+    #   or an m x 4 array of them, giving an m x n array of LOS displacements
+    # eparams and data are as for rect_shear_fault (only Poisson's ratio matters here)
+
+    fparams = np.moveaxis(np.asarray(fparams, dtype=float), -1, 0)[..., None]
+    dx = data[:,0]-fparams[0]
+    dy = data[:,1]-fparams[1]
+    d = fparams[2]
+
+    # displacements point away from the source, scaled by (1-nu) dV / pi R^3
+    C = (1-poisson_ratio(eparams))*fparams[3]/(pi*(dx*dx + dy*dy + d*d)**1.5)
+
+    ULOS = C*(np.multiply(dx,data[:,3]) + np.multiply(dy,data[:,4]) + np.multiply(d,data[:,5]))
+
+    return ULOS
+
+def mctigue_source(fparams, eparams, data):
+    "McTigue (1987) finite spherical pressure source model"
+
+    # fparams is a vector of source parameters
+    #   5 numbers: x, y, depth, radius, pressure change
+    #      positions and radius in meters, pressure change in Pa
+    #   or an m x 5 array of them, giving an m x n array of LOS displacements
+    # eparams and data are as for rect_shear_fault
+    # for a radius much smaller than the depth this is the same as a Mogi source
+
+    nu = poisson_ratio(eparams)
+    mu = eparams[1]
+
+    fparams = np.moveaxis(np.asarray(fparams, dtype=float), -1, 0)[..., None]
+    dx = data[:,0]-fparams[0]
+    dy = data[:,1]-fparams[1]
+    d = fparams[2]
+    a = fparams[3]
+    R2 = dx*dx + dy*dy + d*d
+
+    # the Mogi term, with McTigue's correction for the finite size of the source
+    C = a**3*fparams[4]*(1-nu)/(mu*R2**1.5)
+    C = C*(1 + (a/d)**3*((1+nu)/(2*(-7+5*nu)) + 15*d*d*(-2+nu)/(4*R2*(-7+5*nu))))
+
+    ULOS = C*(np.multiply(dx,data[:,3]) + np.multiply(dy,data[:,4]) + np.multiply(d,data[:,5]))
+
+    return ULOS
+
+def los_penalty_point(fparams, eparams, data):
+    "Calculates total squared penalty for an Okada point dislocation, removing the best-fitting zero level shift"
+
+    # same inputs as for point_dislocation - a batch of sources gives a vector of penalties
+
+    return shifted_penalty(point_dislocation(fparams, eparams, data), data)
+
+def los_penalty_mogi(fparams, eparams, data):
+    "Calculates total squared penalty for a Mogi source, removing the best-fitting zero level shift"
+
+    # same inputs as for mogi_source - a batch of sources gives a vector of penalties
+
+    return shifted_penalty(mogi_source(fparams, eparams, data), data)
+
+def los_penalty_mctigue(fparams, eparams, data):
+    "Calculates total squared penalty for a McTigue source, removing the best-fitting zero level shift"
+
+    # same inputs as for mctigue_source - a batch of sources gives a vector of penalties
+
+    return shifted_penalty(mctigue_source(fparams, eparams, data), data)
+
+class CompositeModel:
+    "Several sources added together, with each source's LOS contribution kept until its parameters change"
+
+    # sources is a list of (forward model, fparams) pairs, e.g.
+    #   [(rect_shear_fault, fault1), (rect_shear_fault, fault2), (rect_tensile_fault, dyke)]
+    #   - any of the okapy models taking (fparams, eparams, data) will do
+    # eparams and data are as for rect_shear_fault
+    # the parameters of all the sources are handled as one flat vector (see params), so
+    #   that composite.penalty can go straight into scipy.optimize.minimize - when the optimizer
+    #   moves one parameter, only the source it belongs to is recomputed
+    # evaluations counts how many single-source forward models have been computed
+
+    def __init__(self, sources, eparams, data):
+
+        self.models = [model for model, fparams in sources]
+        self.fparams = [np.array(fparams, dtype=float) for model, fparams in sources]
+        self.eparams = eparams
+        self.data = data
+
+        # work out every source once to start with
+        self.contributions = [model(fparams, eparams, data) for model, fparams in zip(self.models, self.fparams)]
+        self.total = np.sum(self.contributions, axis=0)
+        self.evaluations = len(self.models)
+
+    def params(self):
+        "All the source parameters as one flat vector"
+
+        return np.concatenate(self.fparams)
+
+    def update(self, params):
+        "Sets the source parameters from a flat vector, recomputing only the sources that have changed"
+
+        start = 0
+        for i, model in enumerate(self.models):
+            fparams = np.asarray(params[start:start+len(self.fparams[i])], dtype=float)
+            start += len(fparams)
+
+            if not np.array_equal(fparams, self.fparams[i]):
+                contribution = model(fparams, self.eparams, self.data)
+                self.total += contribution-self.contributions[i]   # swap the old contribution for the new
+                self.contributions[i] = contribution
+                self.fparams[i] = fparams.copy()
+                self.evaluations += 1
+
+    def los(self, params=None):
+        "Total LOS displacements, for the current parameters or a new flat vector of them"
+
+        if params is not None:
+            self.update(params)
+
+        return self.total.copy()
+
+    def penalty(self, params=None):
+        "Total squared penalty of the summed model, removing the best-fitting zero level shift"
+
+        if params is not None:
+            self.update(params)
+
+        return shifted_penalty(self.total, self.data)
+
+def summed_area_table(a, dtype=float):
+    "Summed-area table of a raster, padded with a leading row and column of zeros"
+
+    # a is a 2-D array (NaNs should be zeroed first)
+    # dtype is the type to accumulate in - np.int32 is plenty for counts, and half the memory
+    # returns an (ny+1) x (nx+1) array - the sum over rows r0:r1 and columns c0:c1 of a is
+    #   sat[r1,c1] - sat[r0,c1] - sat[r1,c0] + sat[r0,c0], whatever the size of the block
+
+    sat = np.zeros((a.shape[0]+1, a.shape[1]+1), dtype=dtype)
+    np.cumsum(a, axis=1, dtype=dtype, out=sat[1:,1:])
+
+    # add the rows down one at a time - contiguous, so much quicker than cumsum down axis 0
+    for i in range(1, a.shape[0]):
+        np.add(sat[i], sat[i+1], out=sat[i+1])
+
+    return sat
+
+def tile_grid(shape, size):
+    "A raster split into a grid of square tiles, clipped at its edges"
+
+    # shape is the raster size as (rows, columns) and size the tile size in pixels
+    # returns a k x 4 array of tiles (first row, first column, last row+1, last column+1)
+
+    r0, c0 = np.meshgrid(np.arange(0, shape[0], size), np.arange(0, shape[1], size), indexing='ij')
+
+    return np.column_stack((r0.ravel(), c0.ravel(),
+                            np.minimum(r0.ravel()+size, shape[0]), np.minimum(c0.ravel()+size, shape[1])))
+
+def split_tiles(tiles):
+    "Quarters each of a set of tiles"
+
+    # tiles is a k x 4 array, as from tile_grid
+    # returns the children (fewer than four where a tile is only one pixel across)
+
+    r0, c0, r1, c1 = tiles.T
+    rm = r0 + (r1-r0+1)//2
+    cm = c0 + (c1-c0+1)//2
+    tiles = np.vstack((np.column_stack((r0, c0, rm, cm)), np.column_stack((r0, cm, rm, c1)),
+                       np.column_stack((rm, c0, r1, cm)), np.column_stack((rm, cm, r1, c1))))
+
+    return tiles[(tiles[:,2] > tiles[:,0]) & (tiles[:,3] > tiles[:,1])]
+
+def quadtree_leaves(disp, epsilon, nan_allowed=0.5, max_size=256, min_size=4):
+    "Quadtree decomposition of a displacement raster, one level of tiles at a time"
+
+    # disp is a 2-D array of displacements in meters, with NaNs where there are no data
+    # epsilon is the variance threshold (m^2) - tiles with more variance than this get split
+    # nan_allowed is the largest fraction of NaN pixels a leaf can have (0 to 1)
+    # max_size and min_size are the largest and smallest tile sizes in pixels - the raster starts
+    #   out as a grid of max_size tiles, and tiles smaller than 2*min_size are never split
+    # returns a k x 4 array of leaves (first row, first column, last row+1, last column+1)
+    #   and a vector of their mean displacements
+    # means and variances come from summed-area tables, so each tile costs the same
+    #   handful of lookups whatever its size, and every tile in a level is done at once
+
+    valid = np.isfinite(disp)
+
+    # take off the overall mean first, so that the sums of squares don't lose precision
+    ref = np.mean(disp[valid]) if valid.any() else 0.0
+    d = np.where(valid, disp-ref, 0.0)
+    tables = [summed_area_table(valid, np.int32), summed_area_table(d), summed_area_table(d*d)]
+    del d
+
+    tiles = tile_grid(disp.shape, max_size)
+    leaves = []
+    means = []
+    while len(tiles):
+        r0, c0, r1, c1 = tiles.T
+        n, s, ss = [sat[r1,c1] - sat[r0,c1] - sat[r1,c0] + sat[r0,c0] for sat in tables]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = s/n
+            var = ss/n - mean**2
+
+        # split noisy tiles that are still big enough, keep the rest if they have enough data
+        split = (n > 0) & (var > epsilon) & (np.maximum(r1-r0, c1-c0) >= 2*min_size)
+        keep = ~split & (n > 0) & (n >= (1.0-nan_allowed)*(r1-r0)*(c1-c0))
+        leaves.append(tiles[keep])
+        means.append(mean[keep]+ref)
+
+        tiles = split_tiles(tiles[split])
+
+    return np.vstack(leaves), np.concatenate(means)
+
+def quadtree_decimate(disp, los, geotransform, epsilon, nan_allowed=0.5, max_size=256, min_size=4):
+    "Downsamples a displacement raster to a data array by quadtree decomposition"
+
+    # disp and the quadtree settings are as for quadtree_leaves
+    # los is a 3 x ny x nx array of unit LOS vector components (see los_vector)
+    # geotransform is the raster's GDAL geotransform
+    # returns a data array from leaf_data, and the leaves from quadtree_leaves
+
+    leaves, means = quadtree_leaves(disp, epsilon, nan_allowed, max_size, min_size)
+
+    return leaf_data(leaves, means, disp, los, geotransform), leaves
+
+def leaf_data(leaves, means, disp, los, geotransform):
+    "Data array for a set of quadtree leaves - leaf centroids, mean displacements and mean LOS vectors"
+
+    # leaves and means are from quadtree_leaves (or resolution_leaves)
+    # disp, los and geotransform are as for quadtree_decimate
+    # returns a data array as for rect_shear_fault - one row per leaf, positioned at the centroid
+    #   of its valid pixels, in the units of the geotransform
+
+    # label every valid pixel with its leaf (-1 for pixels in no leaf)...
+    labels = np.full(disp.shape, -1, dtype=np.int32)
+    for k, (r0, c0, r1, c1) in enumerate(leaves):
+        labels[r0:r1,c0:c1] = k
+    labels[~np.isfinite(disp)] = -1
+
+    # ...then add up pixel positions and LOS components per leaf, a block of rows at a time
+    #   (bin 0 collects everything outside the leaves)
+    sums = np.zeros((6, len(leaves)+1))
+    ny, nx = disp.shape
+    block = max(1, batch_size // max(1, nx))
+    for i in range(0, ny, block):
+        lab = labels[i:i+block].ravel().astype(np.intp)+1
+        nrows = len(lab)//nx
+        sums[0] += np.bincount(lab, minlength=len(leaves)+1)
+        sums[1] += np.bincount(lab, weights=np.tile(np.arange(nx)+0.5, nrows), minlength=len(leaves)+1)
+        sums[2] += np.bincount(lab, weights=np.repeat(np.arange(i, i+nrows)+0.5, nx), minlength=len(leaves)+1)
+        for j in range(3):
+            sums[3+j] += np.bincount(lab, weights=los[j,i:i+block].ravel(), minlength=len(leaves)+1)
+    cols, rows, losx, losy, losz = sums[1:,1:]/sums[0,1:]
+
+    # pixel centroids to map coordinates
+    x = geotransform[0] + cols*geotransform[1] + rows*geotransform[2]
+    y = geotransform[3] + cols*geotransform[4] + rows*geotransform[5]
+
+    # keep the LOS vectors unit length after averaging
+    norm = np.sqrt(losx**2 + losy**2 + losz**2)
+
+    return np.column_stack((x, y, means, losx/norm, losy/norm, losz/norm))
+
+def resolution_leaves(disp, los, geotransform, fparams, eparams, threshold, n_strike=10, n_dip=5,
+                      nan_allowed=0.5, max_size=256, min_size=4, projection=None, rcond=1e-3):
+    "Quadtree decomposition of a displacement raster driven by data resolution, after Lohman and Simons (2005)"
+
+    # disp, los and geotransform are as for quadtree_decimate, the quadtree settings as for quadtree_leaves
+    # fparams is a preliminary best-fitting fault (as for rect_shear_fault) and eparams as usual
+    #   - the fault is meshed into n_strike x n_dip patches (see mesh_fault), and their Green's
+    #   functions, plus a zero level shift, stand for what the data have to resolve
+    # threshold is the largest diagonal element of the data resolution matrix a leaf can have
+    #   (0 to 1, e.g. 0.05) - leaves that resolve more than this on their own get split, so the
+    #   points end up dense where the model is sensitive and sparse where it isn't
+    # projection is the raster's projection (from read_interferogram) - only needed for lat-long
+    #   rasters, so the tiles can be put in the same UTM meters as fparams
+    # rcond is the cutoff on singular values, relative to the largest, for the resolution matrix
+    # returns leaves and mean displacements, as for quadtree_leaves
+    # while the tree is being built each tile sits at its centre pixel - leaf_data works out the
+    #   proper centroids for the final leaves
+
+    valid = np.isfinite(disp)
+    ref = np.mean(disp[valid]) if valid.any() else 0.0
+    tables = [summed_area_table(valid, np.int32), summed_area_table(np.where(valid, disp-ref, 0.0))]
+
+    patches = mesh_fault(fparams, n_strike, n_dip)
+
+    tiles = tile_grid(disp.shape, max_size)
+    leaves = tiles[:0]
+    while len(tiles):
+        r0, c0, r1, c1 = tiles.T
+        n = tables[0][r1,c1] - tables[0][r0,c1] - tables[0][r1,c0] + tables[0][r0,c0]
+        splittable = np.maximum(r1-r0, c1-c0) >= 2*min_size
+
+        # tiles short of data are split where they can be (they may only be partly masked)
+        #   and dropped otherwise
+        enough = (n > 0) & (n >= (1.0-nan_allowed)*(r1-r0)*(c1-c0))
+        gappy = tiles[~enough & (n > 0) & splittable]
+        tiles = tiles[enough]
+        splittable = splittable[enough]
+
+        # resolution of the leaves so far together with the new tiles - adding data can only lower
+        #   the resolution of the points already there, so leaves never need revisiting
+        candidates = np.vstack((leaves, tiles))
+        rc = (candidates[:,0]+candidates[:,2])//2
+        cc = (candidates[:,1]+candidates[:,3])//2
+        x = geotransform[0] + (cc+0.5)*geotransform[1] + (rc+0.5)*geotransform[2]
+        y = geotransform[3] + (cc+0.5)*geotransform[4] + (rc+0.5)*geotransform[5]
+        points = np.column_stack((x, y, np.zeros(len(x)), los[:,rc,cc].T))
+        if projection is not None:
+            points[:,0:2] = utm_points(points[:,0:2], projection)
+
+        A = np.hstack((distributed_greens(patches, eparams, points), np.ones((len(points), 1))))
+        U, S, VT = np.linalg.svd(A, full_matrices=False)
+        resolution = np.sum(np.square(U[:,S > rcond*S[0]]), axis=1)[len(leaves):]
+
+        split = (resolution > threshold) & splittable
+        leaves = np.vstack((leaves, tiles[~split]))
+        tiles = split_tiles(np.vstack((tiles[split], gappy)))
+
+    r0, c0, r1, c1 = leaves.T
+    n, s = [sat[r1,c1] - sat[r0,c1] - sat[r1,c0] + sat[r0,c0] for sat in tables]
+
+    return leaves, s/n+ref
+
+def resolution_decimate(disp, los, geotransform, fparams, eparams, threshold, n_strike=10, n_dip=5,
+                        nan_allowed=0.5, max_size=256, min_size=4, projection=None, rcond=1e-3):
+    "Downsamples a displacement raster to a data array with point density following model resolution"
+
+    # same inputs as for resolution_leaves
+    # returns a data array from leaf_data (in UTM meters if a lat-long projection is given),
+    #   and the leaves
+    # the usual loop is: quadtree_interferogram, a first inversion (e.g. invert_fault_lsq),
+    #   then this with the best-fitting fault, and invert again with the new data array
+
+    leaves, means = resolution_leaves(disp, los, geotransform, fparams, eparams, threshold, n_strike, n_dip,
+                                      nan_allowed, max_size, min_size, projection, rcond)
+    data = leaf_data(leaves, means, disp, los, geotransform)
+    if projection is not None:
+        data[:,0:2] = utm_points(data[:,0:2], projection)
+
+    return data, leaves
+
+def read_interferogram(ifgname, losname, wavelength, corname=None, cor_thresh=0.25, mskname=None):
+    "Reads an ISCE unwrapped interferogram and its LOS file with GDAL, as in the kite workflow notebook"
+
+    # ifgname is the unwrapped interferogram (e.g. filt_topophase.unw.geo - phase in band 2)
+    # losname is the line-of-sight file (e.g. los.rdr.geo - incidence and pointing in bands 1 and 2)
+    # wavelength is the radar wavelength in meters (e.g. 0.0555 for Sentinel-1)
+    # corname is an optional correlation file (e.g. topophase.cor.geo), used to mask out pixels
+    #   with correlation below cor_thresh
+    # mskname is an optional water mask (e.g. water.msk), masking out pixels where it is zero
+    # returns the displacement raster in meters (NaN where masked), a 3 x ny x nx array of
+    #   unit LOS vector components, and the interferogram's geotransform and projection
+    #   - rasters stay the way up ISCE writes them (top row first), the geotransform takes care of it
+
+    files = open_interferogram(ifgname, losname, corname, mskname)
+    disp, los = read_interferogram_rows(files, wavelength, cor_thresh, 0, files[0].RasterYSize)
+
+    return disp, los, files[0].GetGeoTransform(), files[0].GetProjection()
+
+def open_interferogram(ifgname, losname, corname=None, mskname=None):
+    "Opens an ISCE interferogram and its companion files with GDAL, without reading anything yet"
+
+    # inputs are as for read_interferogram
+    # returns a list of the GDAL datasets: interferogram, LOS, correlation and mask (None if not given)
+
+    from osgeo import gdal   # only needed here, so the rest of okapy works without GDAL
+
+    return [None if name is None else gdal.Open(name, gdal.GA_ReadOnly)
+            for name in (ifgname, losname, corname, mskname)]
+
+def read_interferogram_rows(files, wavelength, cor_thresh, yoff, rows):
+    "Reads a block of rows of an ISCE interferogram, masked and converted as in read_interferogram"
+
+    # files is from open_interferogram, wavelength and cor_thresh are as for read_interferogram
+    # yoff is the first row to read and rows the number of rows
+    # returns the displacements in meters (rows x nx, NaN where masked) and a 3 x rows x nx
+    #   array of unit LOS vector components
+
+    ifgfile, losfile, corfile, mskfile = files
+    nx = ifgfile.RasterXSize
+
+    amp = ifgfile.GetRasterBand(1).ReadAsArray(0, yoff, nx, rows)
+    disp = ifgfile.GetRasterBand(2).ReadAsArray(0, yoff, nx, rows)*(wavelength/4/pi)
+
+    # no amplitude means no data (outside the frame)
+    disp[amp == 0] = np.nan
+    del amp
+
+    if corfile is not None:
+        disp[corfile.GetRasterBand(2).ReadAsArray(0, yoff, nx, rows) < cor_thresh] = np.nan
+
+    if mskfile is not None:
+        disp[mskfile.GetRasterBand(1).ReadAsArray(0, yoff, nx, rows) < 1] = np.nan
+
+    los = los_vector(losfile.GetRasterBand(1).ReadAsArray(0, yoff, nx, rows),
+                     losfile.GetRasterBand(2).ReadAsArray(0, yoff, nx, rows))
+
+    return disp, los
+
+def quadtree_interferogram(ifgname, losname, wavelength, epsilon, nan_allowed=0.5, max_size=256, min_size=4,
+                           corname=None, cor_thresh=0.25, mskname=None):
+    "Reads and quadtree-decimates an ISCE interferogram into a data array, in UTM meters"
+
+    # file inputs are as for read_interferogram, quadtree settings as for quadtree_leaves
+    # returns a data array as for rect_shear_fault, and the leaves from quadtree_leaves
+    #   - if the interferogram is geocoded in lat-long, the leaf positions are converted to UTM
+    #   (in the zone of the middle of the data), otherwise they stay in its projected coordinates
+    # np.savetxt(outfile, np.column_stack((data[:,:2]/1000, data[:,2:], np.arange(1, len(data)+1))),
+    #   fmt='%f %f %f %f %f %f %d') writes the same .okinv format as the kite notebook
+
+    disp, los, geotransform, projection = read_interferogram(ifgname, losname, wavelength, corname,
+                                                             cor_thresh, mskname)
+    data, leaves = quadtree_decimate(disp, los, geotransform, epsilon, nan_allowed, max_size, min_size)
+    data[:,0:2] = utm_points(data[:,0:2], projection)
+
+    return data, leaves
+
+def utm_points(xy, projection):
+    "Converts points from a lat-long projection to UTM meters (anything else is left as it is)"
+
+    # xy is an n x 2 array of x, y (longitude, latitude) coordinates
+    # projection is the WKT projection of the raster they came from
+    # returns an n x 2 array, in the UTM zone of the middle of the points
+
+    transform = utm_transform(projection, np.mean(xy[:,0]), np.mean(xy[:,1]))
+    if transform is None:
+        return xy
+
+    return np.array(transform.TransformPoints(xy.tolist()))[:,0:2]
+
+def utm_transform(projection, lon, lat):
+    "GDAL coordinate transformation from a lat-long projection to the UTM zone containing a point"
+
+    # projection is a WKT projection, lon and lat the point that picks the zone
+    # returns an osr.CoordinateTransformation, or None if the projection isn't lat-long
+
+    from osgeo import osr   # only needed here, so the rest of okapy works without GDAL
+
+    src = osr.SpatialReference(wkt=projection)
+    if not src.IsGeographic():
+        return None
+
+    dst = osr.SpatialReference()
+    dst.SetWellKnownGeogCS('WGS84')
+    dst.SetUTM(int((lon+180)//6)+1, int(lat >= 0))
+    for srs in (src, dst):
+        if hasattr(srs, 'SetAxisMappingStrategy'):   # GDAL 3 - keep x, y as lon, lat
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    return osr.CoordinateTransformation(src, dst)
+
+def stream_shear_fault(fparams, eparams, ifgname, losname, wavelength, modelname, residualname=None,
+                       zero_shift=0.0, corname=None, cor_thresh=0.25, mskname=None, block_rows=None):
+    "Full-resolution Okada model and residual maps of an interferogram, a block of rows at a time, written to GeoTIFF"
+
+    # fparams and eparams are as for rect_shear_fault, in the same meters as the data array the
+    #   fault was fitted to (UTM, in the zone of the middle of the scene, for lat-long rasters -
+    #   as from quadtree_interferogram)
+    # file inputs are as for read_interferogram
+    # modelname is the GeoTIFF to write the LOS model to, residualname an optional GeoTIFF for the
+    #   residual (data - zero_shift - model, NaN where the data are masked)
+    # zero_shift is the zero level shift to take off the residuals (e.g. from the decimated fit)
+    # block_rows is the number of rows read, modelled and written at a time - by default enough
+    #   for batch_size pixels, rounded down to whole 256-row tiles where that's possible
+    # only one block of rasters is ever in memory, so the size of the scene doesn't matter
+    # returns the number of pixels modelled
+
+    from osgeo import gdal
+
+    files = open_interferogram(ifgname, losname, corname, mskname)
+    ny, nx = files[0].RasterYSize, files[0].RasterXSize
+    geotransform = files[0].GetGeoTransform()
+    projection = files[0].GetProjection()
+
+    # one UTM zone for the whole scene, picked by its middle
+    transform = utm_transform(projection, geotransform[0] + nx/2*geotransform[1] + ny/2*geotransform[2],
+                              geotransform[3] + nx/2*geotransform[4] + ny/2*geotransform[5])
+
+    if block_rows is None:
+        block_rows = max(1, batch_size // nx)
+        if block_rows >= 256:
+            block_rows -= block_rows % 256
+
+    # tiled, compressed float32 outputs on the interferogram's grid
+    driver = gdal.GetDriverByName('GTiff')
+    options = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER']
+    outputs = []
+    for name in (modelname, residualname):
+        if name is None:
+            outputs.append(None)
+            continue
+        out = driver.Create(name, nx, ny, 1, gdal.GDT_Float32, options=options)
+        out.SetGeoTransform(geotransform)
+        out.SetProjection(projection)
+        out.GetRasterBand(1).SetNoDataValue(np.nan)
+        outputs.append(out)
+
+    # convert slip and rake to strike-slip and dip-slip
+    ss=fparams[3]*cos(radians(fparams[2]))
+    ds=fparams[3]*sin(radians(fparams[2]))
+
+    cols = np.arange(nx)+0.5
+    for yoff in range(0, ny, block_rows):
+        rows = min(block_rows, ny-yoff)
+        disp, los = read_interferogram_rows(files, wavelength, cor_thresh, yoff, rows)
+
+        # pixel-centre coordinates of the block
+        r = np.arange(yoff, yoff+rows)[:,None]+0.5
+        x = geotransform[0] + cols[None,:]*geotransform[1] + r*geotransform[2]
+        y = geotransform[3] + cols[None,:]*geotransform[4] + r*geotransform[5]
+        if transform is not None:
+            xy = np.array(transform.TransformPoints(np.column_stack((x.ravel(), y.ravel())).tolist()))
+            x = xy[:,0].reshape(rows, nx)
+            y = xy[:,1].reshape(rows, nx)
+
+        UX, UY, UZ = shear_fault_enu(fparams, eparams, x, y, [ss, ds, 0.0])
+        ULOS = UX*los[0] + UY*los[1] + UZ*los[2]
+
+        if outputs[0] is not None:
+            outputs[0].GetRasterBand(1).WriteArray(ULOS.astype(np.float32), 0, yoff)
+        if outputs[1] is not None:
+            outputs[1].GetRasterBand(1).WriteArray((disp-zero_shift-ULOS).astype(np.float32), 0, yoff)
+
+    # the files are closed when the datasets go out of scope, but flush them now anyway
+    for out in outputs:
+        if out is not None:
+            out.FlushCache()
+
+    return nx*ny
+
+def file_hash(filename):
+    "SHA-1 hash of a file's contents, read a megabyte at a time"
+
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def load_okinv(filename, cache=True):
+    "Loads an .okinv data file, converted to meters, via a memory-mapped .npy copy that is only made once"
+
+    # filename is a text file in okinv format (see the kite workflow notebook) - seven columns:
+    #   x_pos and y_pos in km, displacement in m, x_los, y_los, z_los and an id number
+    # returns a data array as for rect_shear_fault, positions already in meters (no more
+    #   data[:,0]=data[:,0]*1000 needed), with the id number kept as a seventh column
+    # the first load parses the text and saves filename+'.npy' (and filename+'.json', recording the
+    #   text file's size, modification time and hash) - later loads just memory-map the .npy,
+    #   as long as the text file is unchanged. If its modification time has changed, it is
+    #   hashed, and only parsed again if the hash has changed too
+    # the array is column-major, so each column is contiguous, and read-only - take a copy
+    #   if you want to edit it
+    # cache=False skips the .npy altogether and just parses the text
+
+    if not cache:
+        return parse_okinv(filename)
+
+    npyname = filename+'.npy'
+    jsonname = filename+'.json'
+    stat = os.stat(filename)
+
+    meta = None
+    if os.path.exists(npyname) and os.path.exists(jsonname):
+        with open(jsonname) as f:
+            meta = json.load(f)
+
+    if meta is not None and meta['size'] == stat.st_size:
+        if meta['mtime'] == stat.st_mtime_ns:
+            return np.load(npyname, mmap_mode='r')
+
+        # touched but maybe not changed - check the contents before parsing it all again
+        sha = file_hash(filename)
+        if meta['sha1'] == sha:
+            meta['mtime'] = stat.st_mtime_ns
+            write_json_atomic(jsonname, meta)
+            return np.load(npyname, mmap_mode='r')
+
+    data = parse_okinv(filename)
+
+    # write both files under temporary names first, so that an interrupted save never leaves
+    #   a sidecar that looks valid
+    with open(npyname+'.tmp', 'wb') as f:
+        np.save(f, np.asfortranarray(data))
+    os.replace(npyname+'.tmp', npyname)
+    write_json_atomic(jsonname, {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': file_hash(filename)})
+
+    return np.load(npyname, mmap_mode='r')
+
+def parse_okinv(filename):
+    "Parses an .okinv text file into a data array, converting positions from km to meters"
+
+    # filename is as for load_okinv
+
+    data = np.loadtxt(filename, ndmin=2)
+    data[:,0:2] *= 1000
+
+    return data
+
+def write_json_atomic(filename, obj):
+    "Writes an object to a JSON file via a temporary file, so that readers never see half of it"
+
+    with open(filename+'.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.replace(filename+'.tmp', filename)
+
+class MemoPenalty:
+    "A penalty function that remembers the values it has already worked out"
+
+    # penalty is any okapy penalty taking (fparams, eparams, data), e.g. los_penalty_fault or
+    #   los_penalty_tensile - the wrapper is called the same way, so it can go straight into
+    #   scipy.optimize.minimize or multistart_invert
+    # quantum is the spacing that parameter vectors are rounded to before looking them up - one
+    #   number, or one per parameter (e.g. 1e-6*jacobian_scale). The default of 0 only matches
+    #   vectors that are exactly the same
+    # size is the most penalties to keep - the least recently used ones go first
+    # shared=True keeps the table in shared memory, so that every copy of the wrapper sent to
+    #   multistart workers uses (and fills) the same table - use it in a with block, or call
+    #   close() when done, to free the memory
+    # hits counts the penalty evaluations saved, misses the ones actually computed
+    # eparams and data are not part of the key, so use one wrapper per inversion
+
+    ways = 4          # slots per set in the shared table
+    processes = 256   # rows of counts in the shared table - one per worker_pool worker, plus one
+
+    def __init__(self, penalty, quantum=0.0, size=4096, shared=False):
+
+        self.penalty = penalty
+        self.quantum = quantum
+        self.size = size
+        self.shm = None
+        self.owner = False
+
+        if shared:
+            # a set-associative table of rows [check, last used, penalty, key, key], all int64,
+            #   after a clock and a row of [hits, misses] for each process (see counter) - each
+            #   process only ever adds to its own counts, so none get lost
+            n_sets = -(-size//self.ways)
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=8*(1 + 2*self.processes + 5*self.ways*n_sets))
+            self.owner = True
+            self.attach()
+            self.clock[:] = 0
+            self.counts[:] = 0
+            self.table[:] = 0
+        else:
+            self.table = OrderedDict()
+            self.clock = np.zeros(1, dtype=np.int64)
+            self.counts = np.zeros((1, 2), dtype=np.int64)
+
+    def attach(self):
+        "Maps the shared table and counters onto the shared memory"
+
+        buf = np.ndarray((len(self.shm.buf)//8,), dtype=np.int64, buffer=self.shm.buf)
+        self.clock = buf[0:1]
+        self.counts = buf[1:1+2*self.processes].reshape(-1, 2)
+        self.table = buf[1+2*self.processes:].reshape(-1, self.ways, 5)
+
+    def __getstate__(self):
+
+        # copies sent to other processes map the same shared memory, rather than taking a copy of it
+        state = self.__dict__.copy()
+        if self.shm is not None:
+            state['shm'] = self.shm.name
+            del state['clock'], state['counts'], state['table']
+        state['owner'] = False
+
+        return state
+
+    def __setstate__(self, state):
+
+        # every task brings its own copy, but they all share one mapping per process
+        self.__dict__.update(state)
+        if self.shm is not None:
+            if self.shm not in memo_shms:
+                memo_shms[self.shm] = shared_memory.SharedMemory(name=self.shm)
+            self.shm = memo_shms[self.shm]
+            self.attach()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def close(self):
+        "Frees the shared table (the wrapper goes back to an empty private table)"
+
+        # copies in other processes leave the mapping in memo_shms, for any other copies there
+        if self.shm is not None:
+            self.clock = self.clock.copy()
+            self.counts = self.counts.sum(axis=0, keepdims=True)
+            self.table = OrderedDict()
+            if self.owner:
+                self.shm.close()
+                self.shm.unlink()
+            self.shm = None
+
+    @property
+    def hits(self):
+        return int(np.sum(self.counts[:,0]))
+
+    @property
+    def misses(self):
+        return int(np.sum(self.counts[:,1]))
+
+    @property
+    def hit_rate(self):
+        return self.hits/max(1, self.hits + self.misses)
+
+    def key(self, fparams):
+        "Lookup key of a parameter vector, rounded onto the quantum grid"
+
+        fparams = np.asarray(fparams, dtype=float)
+        if np.all(np.asarray(self.quantum) == 0):
+            return fparams.tobytes()
+
+        return np.round(fparams/self.quantum).astype(np.int64).tobytes()
+
+    def __call__(self, fparams, eparams, data):
+
+        key = self.key(fparams)
+        counts = self.counts[self.counter()]
+        if self.shm is None:
+            penalty = self.table.get(key)
+            if penalty is not None:
+                self.table.move_to_end(key)
+                counts[0] += 1
+                return penalty
+        else:
+            digest = np.frombuffer(hashlib.blake2b(key, digest_size=16).digest(), dtype=np.int64)
+            rows = self.table[int(digest[0] % len(self.table))]
+            for row in rows:
+                # another process may be halfway through writing a row, so check it's consistent
+                entry = row.copy()
+                if entry[0] == self.check(entry) and entry[3] == digest[0] and entry[4] == digest[1]:
+                    self.clock[0] += 1
+                    row[1] = self.clock[0]
+                    counts[0] += 1
+                    return float(entry[2:3].view(float)[0])
+
+        penalty = self.penalty(fparams, eparams, data)
+        counts[1] += 1
+
+        if self.shm is None:
+            self.table[key] = penalty
+            if len(self.table) > self.size:
+                self.table.popitem(last=False)
+        else:
+            # overwrite the least recently used row in the set - clearing its check first, so that
+            #   nobody reads it while it is half written
+            row = rows[np.argmin(rows[:,1])]
+            self.clock[0] += 1
+            row[0] = 0
+            row[1] = self.clock[0]
+            row[2:3].view(float)[0] = penalty
+            row[3:5] = digest
+            row[0] = self.check(row)
+
+        return penalty
+
+    def counter(self):
+        "Which row of counts belongs to this process"
+
+        # worker_pool numbers its workers once each as they start, so they get a row each without
+        #   having to claim one - row 0 is for everything else (the process that made the table,
+        #   or processes outside a worker_pool, which may lose a few counts to each other)
+
+        if self.shm is None or worker_index is None:
+            return 0
+
+        return min(worker_index+1, self.processes-1)
+
+    @staticmethod
+    def check(row):
+        "Checksum of a shared table row (never zero, so that empty rows never match)"
+
+        return (row[2] ^ row[3] ^ row[4]) | 1
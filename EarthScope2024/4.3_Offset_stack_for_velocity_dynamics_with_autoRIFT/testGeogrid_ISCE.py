@@ -27,6 +27,7 @@
 #
 # Authors: Piyush Agram, Yang Lei
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+import json
 from typing import Tuple
 from pathlib import Path
 
@@ -279,7 +280,41 @@ def coregisterLoadMetadataOptical(indir_m, indir_s, **kwargs):
     return info, info1
 
 
-def runGeogrid(info, info1, dem, dhdx, dhdy, vx, vy, srx, sry, csminx, csminy, csmaxx, csmaxy, ssm, init_only=False, **kwargs):
+def getEPSG(dem_info, default=None):
+    '''
+    EPSG code of the DEM projection, from its gdal.Info json; default if GDAL can't identify it.
+    '''
+    from osgeo import osr
+
+    # with GDAL exceptions on, an unidentifiable projection raises rather than returning an error code
+    try:
+        srs = osr.SpatialReference(wkt=dem_info['coordinateSystem']['wkt'])
+        srs.AutoIdentifyEPSG()
+        code = srs.GetAuthorityCode(None)
+    except (KeyError, RuntimeError):
+        return default
+
+    return default if code is None else int(code)
+
+
+def existingFile(filename):
+    '''
+    The file name if that file exists, otherwise None.
+    '''
+    return filename if filename is not None and Path(filename).exists() else None
+
+
+def writeRunInfo(run_info, filename):
+    '''
+    Save the geogrid run info as a JSON sidecar, so autoRIFT can read it back instead of grepping the log.
+    '''
+    # numpy scalars (pixel sizes, offsets, ...) go in as plain Python numbers
+    with open(filename, 'w') as f:
+        json.dump(run_info, f, indent=2, default=lambda value: value.item())
+
+
+def runGeogrid(info, info1, dem, dhdx, dhdy, vx, vy, srx, sry, csminx, csminy, csmaxx, csmaxy, ssm, init_only=False,
+               run_info_file='testGeogrid.json', **kwargs):
     '''
     Wire and run geogrid.
     '''
@@ -344,25 +379,30 @@ def runGeogrid(info, info1, dem, dhdx, dhdy, vx, vy, srx, sry, csminx, csminy, c
         'gridspacingx': obj.gridSpacingX,
         'vxname': vx,
         'vyname': vy,
-        'sxname': kwargs.get('dhdxs'),
-        'syname': kwargs.get('dhdys'),
-        'maskname': kwargs.get('sp'),
+        'sxname': kwargs.get('dhdxs', existingFile(None if dhdx is None else dhdx[:-4]+'s.tif')),
+        'syname': kwargs.get('dhdys', existingFile(None if dhdy is None else dhdy[:-4]+'s.tif')),
+        'maskname': kwargs.get('sp', existingFile(None if dhdy is None else dhdy[:-8]+'sp.tif')),
         'xoff': obj.pOff,
         'yoff': obj.lOff,
         'xcount': obj.pCount,
         'ycount': obj.lCount,
         'dt': obj.repeatTime,
-        'epsg': kwargs.get('epsg'),
+        'epsg': kwargs['epsg'] if 'epsg' in kwargs else getEPSG(dem_info, getattr(obj, 'epsg', None)),
         'XPixelSize': obj.X_res,
         'YPixelSize': obj.Y_res,
         'cen_lat': obj.cen_lat,
         'cen_lon': obj.cen_lon,
+        'winlocname': obj.winlocname,
     }
 
+    if run_info_file is not None:
+        writeRunInfo(run_info, run_info_file)
+
     return run_info
 
 
-def runGeogridOptical(info, info1, dem, dhdx, dhdy, vx, vy, srx, sry, csminx, csminy, csmaxx, csmaxy, ssm, **kwargs):
+def runGeogridOptical(info, info1, dem, dhdx, dhdy, vx, vy, srx, sry, csminx, csminy, csmaxx, csmaxy, ssm,
+                      run_info_file='testGeogrid.json', **kwargs):
     '''
     Wire and run geogrid.
     '''
@@ -428,21 +468,25 @@ def runGeogridOptical(info, info1, dem, dhdx, dhdy, vx, vy, srx, sry, csminx, cs
         'gridspacingx': obj.gridSpacingX,
         'vxname': vx,
         'vyname': vy,
-        'sxname': kwargs.get('dhdxs'),
-        'syname': kwargs.get('dhdys'),
-        'maskname': kwargs.get('sp'),
+        'sxname': kwargs.get('dhdxs', existingFile(None if dhdx is None else dhdx[:-4]+'s.tif')),
+        'syname': kwargs.get('dhdys', existingFile(None if dhdy is None else dhdy[:-4]+'s.tif')),
+        'maskname': kwargs.get('sp', existingFile(None if dhdy is None else dhdy[:-8]+'sp.tif')),
         'xoff': obj.pOff,
         'yoff': obj.lOff,
         'xcount': obj.pCount,
         'ycount': obj.lCount,
         'dt': obj.repeatTime,
-        'epsg': kwargs.get('epsg'),
+        'epsg': kwargs['epsg'] if 'epsg' in kwargs else getEPSG(dem_info, getattr(obj, 'epsg', None)),
         'XPixelSize': obj.X_res,
         'YPixelSize': obj.Y_res,
         'cen_lat': obj.cen_lat,
         'cen_lon': obj.cen_lon,
+        'winlocname': obj.winlocname,
     }
 
+    if run_info_file is not None:
+        writeRunInfo(run_info, run_info_file)
+
     return run_info
 
 def main():
@@ -27,6 +27,9 @@
 #
 # Author: Yang Lei
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+import hashlib
+import json
+import os
 import re
 import warnings
 from osgeo import gdal
@@ -80,6 +83,14 @@ def cmdLineParse():
             help='number of threads for multiple threading (default is specified by 0, which uses the original single-core version and surpasses the multithreading routine)')
     parser.add_argument('-ncname', '--ncname', dest='ncname', type=str, required=False, default=None,
             help='User-defined filename for the NetCDF output to which the ROI percentage and the production version will be appended')
+    parser.add_argument('-tile', '--tile_size', dest='tile_size', type=int, required=False, default=None,
+            help='geogrid tile size (in grid nodes) for tiled, out-of-core processing; default None runs autoRIFT on the whole scene at once')
+    parser.add_argument('-workers', '--workers', dest='workers', type=int, required=False, default=None,
+            help='number of worker processes that share the geogrid tiles (tiled mode; 128-node tiles unless -tile is given); default None runs the tiles in this process')
+    parser.add_argument('-cache', '--cache_dir', dest='cache_dir', type=str, required=False, default=None,
+            help='directory of the preprocessed scene cache shared by the pairs of an offset stack; default None preprocesses every pair')
+    parser.add_argument('-cache_size', '--cache_size', dest='cache_size', type=float, required=False, default=50,
+            help='size limit of the preprocessed scene cache in GB (default 50); least recently used scenes are removed first')
 
     return parser.parse_args()
 
@@ -87,6 +98,27 @@ class Dummy(object):
     pass
 
 
+def loadGeogridRunInfo(filename='testGeogrid.json'):
+    '''
+    Load the run info sidecar written by testGeogrid_ISCE.runGeogrid; None if there isn't one (legacy runs)
+    or if it is left over from an earlier geogrid run.
+    '''
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename) as f:
+        run_info = json.load(f)
+
+    # the sidecar is written after the geogrid's window_location file, so one that is older than it
+    # belongs to some earlier run (testGeogrid.txt itself can't be used, it is flushed after the sidecar)
+    winlocname = run_info.get('winlocname', 'window_location.tif')
+    if os.path.exists(winlocname) and os.path.getmtime(filename) < os.path.getmtime(winlocname):
+        warnings.warn('{0} is older than {1}, ignoring it'.format(filename, winlocname))
+        return None
+
+    return run_info
+
+
 
 def loadProduct(filename):
     '''
@@ -102,7 +134,30 @@ def loadProduct(filename):
     return img
 
 
-def loadProductOptical(file_m, file_s):
+class GdalWindow(object):
+    '''
+    Window of a single-band GDAL raster that is only read (as float32) when sliced.
+    '''
+    def __init__(self, filename, xoff, yoff, xsize, ysize):
+        self.filename = filename
+        self.xoff = xoff
+        self.yoff = yoff
+        self.shape = (ysize, xsize)
+
+    def __getitem__(self, key):
+        import numpy as np
+
+        r0, r1, _ = key[0].indices(self.shape[0])
+        c0, c1, _ = key[1].indices(self.shape[1])
+
+        ds = gdal.Open(self.filename)
+        data = ds.ReadAsArray(xoff=self.xoff+c0, yoff=self.yoff+r0, xsize=c1-c0, ysize=r1-r0)
+        ds = None
+
+        return data.astype(np.float32)
+
+
+def loadProductOptical(file_m, file_s, lazy=False):
     import numpy as np
     '''
     Load the product using Product Manager.
@@ -115,6 +170,10 @@ def loadProductOptical(file_m, file_s):
 
     x1a, y1a, xsize1, ysize1, x2a, y2a, xsize2, ysize2, trans = obj.coregister(file_m, file_s)
 
+    # tiled runs read only the windows they need
+    if lazy:
+        return GdalWindow(file_m, x1a, y1a, xsize1, ysize1), GdalWindow(file_s, x2a, y2a, xsize2, ysize2)
+
     DS1 = gdal.Open(file_m)
     DS2 = gdal.Open(file_s)
 
@@ -130,9 +189,57 @@ def loadProductOptical(file_m, file_s):
     return I1, I2
 
 
+def gridSampleIndex(xGrid, yGrid, nodata):
+    '''
+    Locate the image pixels sampled by every geogrid node that is not nodata.
+    '''
+    import numpy as np
+
+    # geogrid pixel indices are 1-based; a 0 index wraps to the last row/column, as it always has
+    ii, jj = np.nonzero((yGrid != nodata) & (xGrid != nodata))
+
+    return ii, jj, yGrid[ii, jj] - 1, xGrid[ii, jj] - 1
+
+
+def getChipSize0X(geogrid_run_info=None):
+    '''
+    Smallest chip size and grid spacing in image pixels, from the geogrid run info (or testGeogrid.txt).
+    '''
+    import numpy as np
+
+    if geogrid_run_info is None:
+        gridspacingx = float(str.split(runCmd('fgrep "Grid spacing in m:" testGeogrid.txt'))[-1])
+        chipsizex0 = float(str.split(runCmd('fgrep "Smallest Allowable Chip Size in m:" testGeogrid.txt'))[-1])
+        try:
+            pixsizex = float(str.split(runCmd('fgrep "Ground range pixel size:" testGeogrid.txt'))[-1])
+        except:
+            pixsizex = float(str.split(runCmd('fgrep "X-direction pixel size:" testGeogrid.txt'))[-1])
+    else:
+        gridspacingx = geogrid_run_info['gridspacingx']
+        chipsizex0 = geogrid_run_info['chipsizex0']
+        pixsizex = geogrid_run_info['XPixelSize']
+
+    ChipSize0X = int(np.ceil(chipsizex0/pixsizex/4)*4)
+    GridSpacingX = int(ChipSize0X*gridspacingx/chipsizex0)
+
+    return ChipSize0X, GridSpacingX
+
+
+def uniformUint8(I, mean, std):
+    '''
+    Scale an image to uint8 over mean +/- 3 std, as autoRIFT's uniform_data_type does.
+    '''
+    import numpy as np
+
+    I = (I - (mean - 3*std)) / (6*std) * (2**8 - 0)
+
+    return np.round(np.clip(I, 0, 255)).astype(np.uint8)
+
+
 def runAutorift(I1, I2, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CSMAXx0, CSMAXy0, noDataMask, optflag,
                 nodata, mpflag, geogrid_run_info=None, preprocessing_methods=('hps', 'hps'),
-                preprocessing_filter_width=5, zero_mask=None):
+                preprocessing_filter_width=5, zero_mask=None, uniform_stats=None, scale_chip_size_y=None,
+                preprocessed=False, scene_cache=None, scene_ids=None):
     '''
     Wire and run geogrid.
     '''
@@ -146,6 +253,10 @@ def runAutorift(I1, I2, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CS
     import time
     import subprocess
 
+    # only fall back to grepping testGeogrid.txt for geogrid runs that predate the JSON sidecar
+    if geogrid_run_info is None:
+        geogrid_run_info = loadGeogridRunInfo()
+
     obj = autoRIFT_ISCE()
     obj.configure()
 
@@ -154,8 +265,8 @@ def runAutorift(I1, I2, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CS
 
     obj.MultiThread = mpflag
 
-    # take the amplitude only for the radar images
-    if optflag == 0:
+    # take the amplitude only for the radar images (the scene cache does that itself, and only on a miss)
+    if optflag == 0 and not preprocessed and scene_cache is None:
         I1 = np.abs(I1)
         I2 = np.abs(I2)
 
@@ -201,17 +312,16 @@ def runAutorift(I1, I2, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CS
     #        has proved too difficult, so lets just turn it off if `wallis_fill` preprocessing is going to be used.
     #        However, we do have the image zero_mask already, so we can use that to create the output product noDataMask
     # generate the nodata mask where offset searching will be skipped based on 1) imported nodata mask and/or 2) zero values in the image
-    if 'wallis_fill' not in preprocessing_methods:
-        for ii in range(obj.xGrid.shape[0]):
-            for jj in range(obj.xGrid.shape[1]):
-                if (obj.yGrid[ii,jj] != nodata)&(obj.xGrid[ii,jj] != nodata):
-                    if (I1[obj.yGrid[ii,jj]-1,obj.xGrid[ii,jj]-1]==0)|(I2[obj.yGrid[ii,jj]-1,obj.xGrid[ii,jj]-1]==0):
-                        noDataMask[ii,jj] = True
+    # (images that come in preprocessed have had this done by the caller, on the raw pixels)
+    if preprocessed:
+        pass
+    elif 'wallis_fill' not in preprocessing_methods:
+        ii, jj, yy, xx = gridSampleIndex(obj.xGrid, obj.yGrid, nodata)
+        zero = (I1[yy, xx] == 0) | (I2[yy, xx] == 0)
+        noDataMask[ii[zero], jj[zero]] = True
     elif zero_mask is not None:
-        for ii in range(obj.xGrid.shape[0]):
-            for jj in range(obj.xGrid.shape[1]):
-                if (obj.yGrid[ii, jj] != nodata) & (obj.xGrid[ii, jj] != nodata):
-                    noDataMask[ii, jj] = zero_mask[obj.yGrid[ii,jj]-1,obj.xGrid[ii,jj]-1]
+        ii, jj, yy, xx = gridSampleIndex(obj.xGrid, obj.yGrid, nodata)
+        noDataMask[ii, jj] = zero_mask[yy, xx]
 
     ######### mask out nodata to skip the offset searching using the nodata mask (by setting SearchLimit to be 0)
 
@@ -233,24 +343,14 @@ def runAutorift(I1, I2, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CS
         obj.ChipSizeMaxX = CSMAXx0
         obj.ChipSizeMinX = CSMINx0
 
-        if geogrid_run_info is None:
-            gridspacingx = float(str.split(runCmd('fgrep "Grid spacing in m:" testGeogrid.txt'))[-1])
-            chipsizex0 = float(str.split(runCmd('fgrep "Smallest Allowable Chip Size in m:" testGeogrid.txt'))[-1])
-            try:
-                pixsizex = float(str.split(runCmd('fgrep "Ground range pixel size:" testGeogrid.txt'))[-1])
-            except:
-                pixsizex = float(str.split(runCmd('fgrep "X-direction pixel size:" testGeogrid.txt'))[-1])
-        else:
-            gridspacingx = geogrid_run_info['gridspacingx']
-            chipsizex0 = geogrid_run_info['chipsizex0']
-            pixsizex = geogrid_run_info['XPixelSize']
-
-        obj.ChipSize0X = int(np.ceil(chipsizex0/pixsizex/4)*4)
-        obj.GridSpacingX = int(obj.ChipSize0X*gridspacingx/chipsizex0)
+        obj.ChipSize0X, obj.GridSpacingX = getChipSize0X(geogrid_run_info)
 
         # obj.ChipSize0X = np.min(CSMINx0[CSMINx0!=nodata])
-        RATIO_Y2X = CSMINy0/CSMINx0
-        obj.ScaleChipSizeY = np.median(RATIO_Y2X[(CSMINx0!=nodata)&(CSMINy0!=nodata)])
+        if scale_chip_size_y is None:
+            RATIO_Y2X = CSMINy0/CSMINx0
+            obj.ScaleChipSizeY = np.median(RATIO_Y2X[(CSMINx0!=nodata)&(CSMINy0!=nodata)])
+        else:
+            obj.ScaleChipSizeY = scale_chip_size_y
         # obj.ChipSizeMaxX = obj.ChipSizeMaxX / obj.ChipSizeMaxX * 544
         # obj.ChipSizeMinX = obj.ChipSizeMinX / obj.ChipSizeMinX * 68
     else:
@@ -292,7 +392,16 @@ def runAutorift(I1, I2, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CS
     # obj.zeroMask = 1
 
     # TODO: Allow different filters to be applied images independently; default to most stringent filtering
-    if 'wallis_fill' in preprocessing_methods:
+    if scene_cache is not None and not preprocessed:
+        # each scene of a stack is preprocessed once and then shared by all of its pairs
+        finite_only = zero_mask is not None and bool({'wallis_fill', 'wallis'} & set(preprocessing_methods))
+        obj.I1, obj.I2 = [np.array(scene_cache.scene(scene_id, I, optflag, preprocessing_methods, obj.WallisFilterWidth,
+                                                     finite_only)) for scene_id, I in zip(scene_ids, (obj.I1, obj.I2))]
+        preprocessed = True
+        # the cached scenes are shared by every pair, so the pair's own zero mask goes on afterwards
+        if finite_only:
+            obj.zeroMask = zero_mask
+    elif 'wallis_fill' in preprocessing_methods:
         # FIXME: Ensuring landsat 7 images are projected correctly requires wallis_fill filtering and then reprojecting the
         #        secondary scene before processing with Geogrid or autoRIFT; this now occurs in hyp3-autorift/process.py
         warnings.warn('Wallis filtering must be done before processing with geogrid! Be careful when using this method',
@@ -317,7 +426,7 @@ def runAutorift(I1, I2, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CS
         # obj.preprocess_filt_fft()
         warnings.warn('FFT filtering must be done before processing with geogrid! Be careful when using this method',
                       UserWarning)
-    else:
+    elif not preprocessed:
         obj.preprocess_filt_hps()
 
     # obj.I1 = np.abs(I1)
@@ -327,7 +436,23 @@ def runAutorift(I1, I2, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CS
 
     t1 = time.time()
     # obj.DataType = 0
-    obj.uniform_data_type()
+    if preprocessed:
+        # already scaled to uint8 by the caller
+        pass
+    elif uniform_stats is None:
+        obj.uniform_data_type()
+    else:
+        # tiles are scaled with the statistics of the whole scene so they all agree with each other, and with a
+        # single-pass run to within 1 DN (the statistics are accumulated in float64 strip by strip, where
+        # uniform_data_type takes float32 means over the whole image)
+        obj.I1 = uniformUint8(obj.I1, *uniform_stats[0])
+        obj.I2 = uniformUint8(obj.I2, *uniform_stats[1])
+    if (preprocessed or uniform_stats is not None) and obj.zeroMask is not None:
+        # uniform_data_type zeroes the masked pixels after scaling, so do the same when it is bypassed
+        zero = np.asarray(obj.zeroMask, dtype=bool)
+        obj.I1[zero] = 0
+        obj.I2[zero] = 0
+        obj.zeroMask = None
     print("Uniform Data Type Done!!!")
     print(time.time()-t1)
 
@@ -419,6 +544,525 @@ def runAutorift(I1, I2, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CS
     return obj.Dx, obj.Dy, obj.InterpMask, obj.ChipSizeX, obj.GridSpacingX, obj.ScaleChipSizeY, obj.SearchLimitX, obj.SearchLimitY, obj.origSize, noDataMask
 
 
+def preprocessedStrips(images, optflag, preprocessing_methods, preprocessing_filter_width, strip_rows=1024):
+    '''
+    Preprocess images strip by strip as runAutorift would; yields (r0, r1, raw strips, filtered strips).
+    '''
+    import numpy as np
+    from autoRIFT import autoRIFT_ISCE
+
+    obj = autoRIFT_ISCE()
+    obj.configure()
+    obj.WallisFilterWidth = preprocessing_filter_width
+
+    # same choice as runAutorift: only the high-pass filter is applied here, the others run before geogrid
+    hps = not ({'wallis_fill', 'wallis', 'fft'} & set(preprocessing_methods))
+    halo = preprocessing_filter_width // 2
+
+    m = images[0].shape[0]
+    for r0 in range(0, m, strip_rows):
+        r1 = min(r0 + strip_rows, m)
+        h0 = max(r0 - halo, 0)
+        h1 = min(r1 + halo, m)
+
+        raws = [I[h0:h1, :] for I in images]
+        if optflag == 0:
+            raws = [np.abs(I) for I in raws]
+
+        filtered = raws
+        if hps:
+            filtered = []
+            for k in range(0, len(raws), 2):
+                # preprocess_filt_hps works on a pair; an odd image out is paired with a 1 x 1 placeholder
+                obj.I1 = raws[k]
+                obj.I2 = raws[k+1] if k + 1 < len(raws) else np.zeros((1, 1), dtype=np.float32)
+                obj.preprocess_filt_hps()
+                filtered += [obj.I1, obj.I2][:len(raws)-k]
+
+        yield r0, r1, [I[r0-h0:r1-h0] for I in raws], [I[r0-h0:r1-h0] for I in filtered]
+
+
+def stripMoments(I, finite_only=False):
+    '''
+    Count, mean and sum of squared deviations of an image (strip), in float64.
+    '''
+    import numpy as np
+
+    if finite_only:
+        I = I[np.isfinite(I)]
+    if I.size == 0:
+        return 0, 0.0, 0.0
+
+    mean = np.mean(I, dtype=np.float64)
+
+    return I.size, float(mean), float(np.sum((I - mean)**2, dtype=np.float64))
+
+
+def sampleStd(count, m2):
+    '''
+    Sample standard deviation from a count and sum of squared deviations, written as uniform_data_type has it.
+    '''
+    import numpy as np
+
+    return float(np.sqrt(m2/count)*np.sqrt(count/(count-1.0)))
+
+
+def sceneStatistics(images, optflag, preprocessing_methods, preprocessing_filter_width, finite_only=False):
+    '''
+    Scene-wide mean and standard deviation of each preprocessed image, accumulated strip by strip.
+    '''
+    # count, mean and sum of squared deviations for each image, merged strip by strip
+    stats = [(0, 0.0, 0.0) for I in images]
+    for r0, r1, raws, filtered in preprocessedStrips(images, optflag, preprocessing_methods, preprocessing_filter_width):
+        for k, I in enumerate(filtered):
+            n, mean, m2 = stripMoments(I, finite_only)
+            if n == 0:
+                continue
+
+            count, total_mean, total_m2 = stats[k]
+            delta = mean - total_mean
+            total = count + n
+            stats[k] = (total, total_mean + delta*n/total, total_m2 + m2 + delta**2*count*n/total)
+
+    return [(mean, sampleStd(count, m2)) for count, mean, m2 in stats]
+
+
+def maskZeroNodes(I1, I2, xGrid, yGrid, nodata, noDataMask, preprocessing_methods, zero_mask=None, strip_rows=1024):
+    '''
+    Mask the grid nodes that sample zero-valued pixels (or the zero mask) as runAutorift does, reading strip by strip.
+    '''
+    ii, jj, yy, xx = gridSampleIndex(xGrid, yGrid, nodata)
+    # 0 indices wrap to the last row/column, as they do in runAutorift
+    yy = yy % I1.shape[0]
+    xx = xx % I1.shape[1]
+
+    if 'wallis_fill' in preprocessing_methods:
+        if zero_mask is not None:
+            noDataMask[ii, jj] = zero_mask[yy, xx]
+        return noDataMask
+
+    for r0 in range(0, I1.shape[0], strip_rows):
+        strip = (yy >= r0) & (yy < r0 + strip_rows)
+        if not strip.any():
+            continue
+        rows = yy[strip] - r0
+        cols = xx[strip]
+        zero = (I1[r0:r0+strip_rows, :][rows, cols] == 0) | (I2[r0:r0+strip_rows, :][rows, cols] == 0)
+        noDataMask[ii[strip][zero], jj[strip][zero]] = True
+
+    return noDataMask
+
+
+def processAlive(pid):
+    '''
+    Whether a process with this id is running on this machine.
+    '''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+class SceneCache(object):
+    '''
+    Disk cache of preprocessed uint8 scenes for offset stacks, size-bounded with least-recently-used eviction.
+    '''
+    tmp_age = 24*3600   # seconds after which a half-built scene is taken to be abandoned
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, scene_id, optflag, preprocessing_methods, preprocessing_filter_width, finite_only=False):
+        '''
+        Hash of the input file identity (path, size, mtime), crop window and preprocessing settings.
+        '''
+        filename, window = scene_id
+        st = os.stat(filename)
+        method = [name for name in ('wallis_fill', 'wallis', 'fft') if name in preprocessing_methods]
+
+        identity = {
+            'file': [os.path.realpath(filename), st.st_size, st.st_mtime_ns],
+            'window': [int(v) for v in window],
+            'optflag': int(optflag),
+            'method': method[0] if method else 'hps',
+            'width': int(preprocessing_filter_width),
+            'finite_only': bool(finite_only),
+        }
+
+        return hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+    def scene(self, scene_id, I, optflag, preprocessing_methods, preprocessing_filter_width, finite_only=False):
+        '''
+        Preprocessed uint8 scene as a read-only memory map; preprocessed (and cached) on a miss.
+        '''
+        import numpy as np
+
+        path = os.path.join(self.directory, self.key(scene_id, optflag, preprocessing_methods,
+                                                     preprocessing_filter_width, finite_only) + '.npy')
+        try:
+            # touching the entry marks it as most recently used
+            os.utime(path)
+            scene = np.load(path, mmap_mode='r')
+            self.hits += 1
+            print(f'Scene cache hit for {scene_id[0]}')
+            return scene
+        except FileNotFoundError:
+            pass
+
+        self.misses += 1
+        print(f'Scene cache miss for {scene_id[0]}')
+
+        tmp = f'{path}.{os.getpid()}.tmp'
+        if isinstance(I, np.ndarray) and not isinstance(I, np.memmap):
+            # already in memory: filter the whole scene in one go
+            r0, r1, raws, filtered = next(preprocessedStrips([I], optflag, preprocessing_methods,
+                                                             preprocessing_filter_width, strip_rows=max(I.shape[0], 1)))
+            count, mean, m2 = stripMoments(filtered[0], finite_only)
+            with open(tmp, 'wb') as f:
+                np.save(f, uniformUint8(filtered[0], mean, sampleStd(count, m2)))
+        else:
+            # out of core: one pass for the statistics, a second one to write the scene strip by strip
+            stats = sceneStatistics([I], optflag, preprocessing_methods, preprocessing_filter_width, finite_only)[0]
+            out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=I.shape)
+            for r0, r1, raws, filtered in preprocessedStrips([I], optflag, preprocessing_methods,
+                                                             preprocessing_filter_width):
+                out[r0:r1] = uniformUint8(filtered[0], *stats)
+            out.flush()
+            del out
+
+        # map the scene before it goes into the cache, so that the mapping survives another run evicting it;
+        # concurrent stack runs may build the same scene, and the rename makes whichever finishes last win
+        scene = np.load(tmp, mmap_mode='r')
+        os.replace(tmp, path)
+        self.evict()
+
+        return scene
+
+    def evict(self):
+        '''
+        Remove the least recently used scenes until the cache fits in max_bytes (the newest one always stays),
+        and any scene left half-built by a run that died.
+        '''
+        import time
+
+        entries = []
+        building = 0
+        for entry in os.scandir(self.directory):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith('.tmp'):
+                # <key>.npy.<pid>.tmp - still being written if that process is alive and it has been touched lately
+                pid = entry.name.split('.')[-2]
+                stale = time.time() - st.st_mtime > self.tmp_age or not pid.isdigit() or not processAlive(int(pid))
+                try:
+                    if stale:
+                        os.remove(entry.path)
+                    else:
+                        building += st.st_size
+                except FileNotFoundError:
+                    pass
+            elif entry.name.endswith('.npy'):
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+
+        entries.sort()
+        total = building + sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            # scenes still mapped by another run stay readable after the unlink
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def tileSlices(shape, tile_size, halo):
+    '''
+    Split a grid into tiles; returns (outer, inner) slice pairs, outer being inner grown by halo nodes on each side.
+    '''
+    tiles = []
+    for r0 in range(0, shape[0], tile_size):
+        for c0 in range(0, shape[1], tile_size):
+            inner = (slice(r0, min(r0+tile_size, shape[0])), slice(c0, min(c0+tile_size, shape[1])))
+            outer = (slice(max(r0-halo, 0), min(r0+tile_size+halo, shape[0])),
+                     slice(max(c0-halo, 0), min(c0+tile_size+halo, shape[1])))
+            tiles.append((outer, inner))
+
+    return tiles
+
+
+def stitchTile(full, tile, outer, inner):
+    '''
+    Copy the inner part of a tile result into the full grid (autoRIFT may have truncated it to its nested grid).
+    '''
+    import numpy as np
+
+    tile = np.asarray(tile)
+    if tile.ndim == 0:
+        full[inner] = tile
+        return
+
+    r = inner[0].start - outer[0].start
+    c = inner[1].start - outer[1].start
+    block = tile[r:r+inner[0].stop-inner[0].start, c:c+inner[1].stop-inner[1].start]
+    full[inner[0].start:inner[0].start+block.shape[0], inner[1].start:inner[1].start+block.shape[1]] = block
+
+
+def gridMagnitude(value, nodata):
+    '''
+    Absolute value of a grid (or of an autoRIFT default scalar) as float32, with nodata nodes set to 0.
+    '''
+    import numpy as np
+
+    value = np.asarray(value, dtype=np.float32)
+
+    return np.abs(np.where(value == nodata, 0, value))
+
+
+tileWorker = Dummy()
+
+
+def initTileWorker(names, shape, settings):
+    '''
+    Pool initializer: attach the shared preprocessed images and keep the run settings in tileWorker.
+    '''
+    import numpy as np
+    from multiprocessing import shared_memory
+    import cv2
+
+    # one process per core already, so OpenCV should not start threads of its own
+    cv2.setNumThreads(1)
+
+    tileWorker.__dict__.update(settings)
+    tileWorker.shm = [shared_memory.SharedMemory(name=name) for name in names]
+    tileWorker.I1, tileWorker.I2 = [np.ndarray(shape, dtype=np.uint8, buffer=m.buf) for m in tileWorker.shm]
+
+
+def autoriftTileTask(task):
+    '''
+    Run autoRIFT on one tile of runAutoriftTiled, with the images and settings held in tileWorker.
+    '''
+    import numpy as np
+
+    outer, inner, (r0, r1, c0, c1), xg, yg, grids, mask = task
+    w = tileWorker
+
+    result = runAutorift(
+        np.array(w.I1[r0:r1, c0:c1]), np.array(w.I2[r0:r1, c0:c1]), xg, yg, *grids, mask, w.optflag, w.nodata,
+        w.mpflag, geogrid_run_info=w.geogrid_run_info, preprocessing_methods=w.preprocessing_methods,
+        preprocessing_filter_width=w.preprocessing_filter_width,
+        zero_mask=None if w.zero_mask is None else w.zero_mask[r0:r1, c0:c1],
+        uniform_stats=w.uniform_stats, scale_chip_size_y=w.scale_chip_size_y, preprocessed=w.preprocessed
+    )
+
+    return outer, inner, result
+
+
+def runAutoriftTiled(I1, I2, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CSMAXx0, CSMAXy0, noDataMask,
+                     optflag, nodata, mpflag, tile_size, halo=None, geogrid_run_info=None,
+                     preprocessing_methods=('hps', 'hps'), preprocessing_filter_width=5, zero_mask=None, workers=None,
+                     scene_cache=None, scene_ids=None):
+    '''
+    Run autoRIFT tile by tile over the geogrid, holding only one tile's image window in memory at a time,
+    or spread the tiles over a pool of worker processes.
+
+    Only the stitching of finished tiles overlaps with the matching. The velocity conversion and the output
+    writing in generateAutoriftProduct still run once every tile is done: the stable-surface shift is a
+    median over the whole scene, and the netCDF packaging takes whole-scene arrays.
+    '''
+    import numpy as np
+    import multiprocessing
+    from multiprocessing import shared_memory
+    from autoRIFT import autoRIFT_ISCE
+
+    if geogrid_run_info is None:
+        geogrid_run_info = loadGeogridRunInfo()
+
+    defaults = autoRIFT_ISCE()
+    defaults.configure()
+
+    valid = np.logical_not(noDataMask) & (xGrid != nodata) & (yGrid != nodata)
+
+    # chip sizes as runAutorift sets them; ScaleChipSizeY is a scene-wide median, so it is fixed up front
+    if CSMINx0 is not None:
+        ChipSize0X = getChipSize0X(geogrid_run_info)[0]
+        ChipSizeMaxX = CSMAXx0
+        RATIO_Y2X = CSMINy0/CSMINx0
+        ScaleChipSizeY = np.median(RATIO_Y2X[(CSMINx0!=nodata)&(CSMINy0!=nodata)])
+    elif optflag == 1:
+        ChipSize0X, ChipSizeMaxX, ScaleChipSizeY = 16, 32, defaults.ScaleChipSizeY
+    else:
+        ChipSize0X, ChipSizeMaxX, ScaleChipSizeY = defaults.ChipSize0X, defaults.ChipSizeMaxX, defaults.ScaleChipSizeY
+
+    # tiles and halos are multiples of the nested-grid factor, so autoRIFT's coarse levels see the same node blocks;
+    # a tile that holds none of the largest chips nests fewer levels, so varying ChipSizeMaxX can differ there
+    ChipSizeMaxX = gridMagnitude(ChipSizeMaxX, nodata)
+    factor = max(int(np.max(np.broadcast_to(ChipSizeMaxX, xGrid.shape)[valid], initial=0) // ChipSize0X), 1)
+
+    # image pixels a node can reach: half a chip plus the search center plus twice the search limit, since the
+    # coarse levels can move the search center by up to one search limit before the finer levels search again
+    marginX = ChipSizeMaxX/2 + gridMagnitude(defaults.Dx0 if Dx0 is None else Dx0, nodata) + \
+        2*gridMagnitude(defaults.SearchLimitX if SRx0 is None else SRx0, nodata)
+    marginY = ChipSizeMaxX*ScaleChipSizeY/2 + gridMagnitude(defaults.Dy0 if Dy0 is None else Dy0, nodata) + \
+        2*gridMagnitude(defaults.SearchLimitY if SRy0 is None else SRy0, nodata)
+    marginX = np.where(valid, marginX, 0).astype(np.float32)
+    marginY = np.where(valid, marginY, 0).astype(np.float32)
+    pad = preprocessing_filter_width + 2
+
+    if halo is None:
+        # grid nodes needed to cover that reach, from the median node spacing in image pixels
+        steps = []
+        for axis in (0, 1):
+            pairs = valid[1:, :] & valid[:-1, :] if axis == 0 else valid[:, 1:] & valid[:, :-1]
+            step = np.hypot(np.diff(xGrid, axis=axis).astype(np.float64), np.diff(yGrid, axis=axis))[pairs]
+            if step.size > 0:
+                steps.append(np.median(step))
+        halo = int(np.ceil(max(marginX.max(), marginY.max()) / min(steps))) if steps else factor
+    halo = int(np.ceil(max(halo, 1) / factor) * factor)
+    tile_size = int(np.ceil(tile_size / factor) * factor)
+
+    finite_only = zero_mask is not None and bool({'wallis_fill', 'wallis'} & set(preprocessing_methods))
+    if scene_cache is not None:
+        # preprocessed scenes come from the stack cache (and are built there on a miss)
+        scenes = [scene_cache.scene(scene_id, I, optflag, preprocessing_methods, preprocessing_filter_width,
+                                    finite_only) for scene_id, I in zip(scene_ids, (I1, I2))]
+        uniform_stats = None
+    else:
+        scenes = None
+        uniform_stats = sceneStatistics([I1, I2], optflag, preprocessing_methods, preprocessing_filter_width,
+                                        finite_only)
+
+    settings = {
+        'optflag': optflag,
+        'nodata': nodata,
+        # the tiles are the parallelism with a worker pool; autoRIFT's own process pool can't be started from
+        # (daemonic) pool workers, and would oversubscribe the cores anyway
+        'mpflag': mpflag if workers is None else 0,
+        'geogrid_run_info': geogrid_run_info,
+        'preprocessing_methods': preprocessing_methods,
+        'preprocessing_filter_width': preprocessing_filter_width,
+        'scale_chip_size_y': ScaleChipSizeY,
+    }
+
+    shm = []
+    noDataMask = noDataMask.copy()
+    if workers is not None or scenes is not None:
+        # tiles get preprocessed images, so the grid nodes that sample zero-valued pixels are masked here, on the
+        # raw images, as runAutorift would (the tiles then skip both steps)
+        noDataMask = maskZeroNodes(I1, I2, xGrid, yGrid, nodata, noDataMask, preprocessing_methods, zero_mask)
+        settings.update(uniform_stats=None, preprocessed=True)
+
+    if workers is not None:
+        # both preprocessed images go into shared memory once, for all the workers
+        shm = [shared_memory.SharedMemory(create=True, size=max(I1.shape[0]*I1.shape[1], 1)) for _ in range(2)]
+        images = [np.ndarray(I1.shape, dtype=np.uint8, buffer=m.buf) for m in shm]
+        if scenes is not None:
+            for image, scene in zip(images, scenes):
+                image[:] = scene
+        else:
+            for r0, r1, raws, filtered in preprocessedStrips([I1, I2], optflag, preprocessing_methods,
+                                                             preprocessing_filter_width):
+                for image, I, stats in zip(images, filtered, uniform_stats):
+                    image[r0:r1] = uniformUint8(I, *stats)
+        if finite_only:
+            # the pair's zero mask, applied after scaling as runAutorift would
+            zero = zero_mask.astype(bool)
+            for image in images:
+                image[zero] = 0
+        del images
+        settings.update(zero_mask=None)
+    elif scenes is not None:
+        # the cached scenes are shared by every pair, so the tiles apply the pair's zero mask to their copies
+        settings.update(I1=scenes[0], I2=scenes[1], zero_mask=zero_mask)
+    else:
+        settings.update(I1=I1, I2=I2, zero_mask=zero_mask, uniform_stats=uniform_stats, preprocessed=False)
+
+    origSize = xGrid.shape
+    Dx = np.full(origSize, np.nan, dtype=np.float32)
+    Dy = np.full(origSize, np.nan, dtype=np.float32)
+    InterpMask = np.zeros(origSize, dtype=np.float32)
+    ChipSizeX = np.zeros(origSize, dtype=np.float32)
+    SearchLimitX = np.zeros(origSize, dtype=np.float32)
+    SearchLimitY = np.zeros(origSize, dtype=np.float32)
+    noDataMaskOut = np.ones(origSize, dtype=bool)
+    GridSpacingX = None
+
+    tiles = tileSlices(origSize, tile_size, halo)
+    tasks = []
+    for k, (outer, inner) in enumerate(tiles):
+        node = valid[outer]
+        if not node.any():
+            continue
+
+        # image window covering every node of the tile and its halo
+        px = xGrid[outer][node] - 1
+        py = yGrid[outer][node] - 1
+        c0 = max(int(np.floor(np.min(px - marginX[outer][node]))) - pad, 0)
+        c1 = min(int(np.ceil(np.max(px + marginX[outer][node]))) + pad + 1, I1.shape[1])
+        r0 = max(int(np.floor(np.min(py - marginY[outer][node]))) - pad, 0)
+        r1 = min(int(np.ceil(np.max(py + marginY[outer][node]))) + pad + 1, I1.shape[0])
+        # even window origins keep round-half-to-even of the (averaged) coarse-level node positions unchanged
+        c0 -= c0 % 2
+        r0 -= r0 % 2
+
+        print(f'Tile {k+1}/{len(tiles)}: grid rows {outer[0].start}-{outer[0].stop}, '
+              f'columns {outer[1].start}-{outer[1].stop}; image window {r1-r0} x {c1-c0}')
+
+        xg = xGrid[outer].copy()
+        yg = yGrid[outer].copy()
+        xg[xg != nodata] -= c0
+        yg[yg != nodata] -= r0
+
+        grids = [None if a is None else a[outer].copy() for a in (Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CSMAXx0, CSMAXy0)]
+
+        tasks.append((outer, inner, (r0, r1, c0, c1), xg, yg, grids, noDataMask[outer].copy()))
+
+    if workers is not None:
+        pool = multiprocessing.Pool(workers, initializer=initTileWorker,
+                                    initargs=([m.name for m in shm], I1.shape, settings))
+        results = pool.imap_unordered(autoriftTileTask, tasks)
+    else:
+        tileWorker.__dict__.update(settings)
+        results = map(autoriftTileTask, tasks)
+
+    # stitch each tile as it finishes, while the workers carry on matching the next ones
+    try:
+        for outer, inner, result in results:
+            for full, part in zip((Dx, Dy, InterpMask, ChipSizeX), result[:4]):
+                stitchTile(full, part, outer, inner)
+            stitchTile(SearchLimitX, result[6], outer, inner)
+            stitchTile(SearchLimitY, result[7], outer, inner)
+            stitchTile(noDataMaskOut, result[9], outer, inner)
+            GridSpacingX, ScaleChipSizeY = result[4], result[5]
+            del result
+    except BaseException:
+        # don't wait for the queued tiles when one of them has failed
+        if workers is not None:
+            pool.terminate()
+        raise
+    finally:
+        if workers is not None:
+            pool.close()
+            pool.join()
+        tileWorker.__dict__.clear()
+        for m in shm:
+            m.close()
+            m.unlink()
+
+    return Dx, Dy, InterpMask, ChipSizeX, GridSpacingX, ScaleChipSizeY, SearchLimitX, SearchLimitY, origSize, noDataMaskOut
+
+
 
 def main():
     '''
@@ -431,7 +1075,8 @@ def main():
                             chip_size_min=inps.chip_size_min,chip_size_max=inps.chip_size_max,
                             offset2vx=inps.offset2vx, offset2vy=inps.offset2vy, scale_factor=inps.scale_factor,
                             stable_surface_mask=inps.stable_surface_mask, optical_flag=inps.optical_flag,
-                            nc_sensor=inps.nc_sensor, mpflag=inps.mpflag, ncname=inps.ncname)
+                            nc_sensor=inps.nc_sensor, mpflag=inps.mpflag, ncname=inps.ncname, tile_size=inps.tile_size,
+                            workers=inps.workers, cache_dir=inps.cache_dir, cache_size=inps.cache_size)
 
 
 def generateAutoriftProduct(indir_m, indir_s, grid_location, init_offset, search_range, chip_size_min, chip_size_max,
@@ -446,8 +1091,29 @@ def generateAutoriftProduct(indir_m, indir_s, grid_location, init_offset, search
     #from components.contrib.geo_autoRIFT.autoRIFT import __version__ as version
     from autoRIFT import __version__ as version
 
+    # only fall back to grepping testGeogrid.txt for geogrid runs that predate the JSON sidecar
+    if geogrid_run_info is None:
+        geogrid_run_info = loadGeogridRunInfo()
+
+    # tiled runs need the geogrid to split the scene; a worker pool implies tiling
+    workers = kwargs.get('workers')
+    tile_size = kwargs.get('tile_size')
+    if tile_size is None and workers is not None:
+        tile_size = 128
+    tiled = tile_size is not None and grid_location is not None
+
+    scene_cache = None
+    scene_ids = None
+    if kwargs.get('cache_dir') is not None:
+        scene_cache = SceneCache(kwargs['cache_dir'], int(kwargs.get('cache_size', 50) * 1e9))
+
     if optical_flag == 1:
-        data_m, data_s = loadProductOptical(indir_m, indir_s)
+        data_m, data_s = loadProductOptical(indir_m, indir_s, lazy=tiled or scene_cache is not None)
+        if scene_cache is not None:
+            # the cache is keyed on the coregistered crop of each scene
+            scene_ids = [(d.filename, (d.xoff, d.yoff, d.shape[1], d.shape[0])) for d in (data_m, data_s)]
+            if not tiled:
+                data_m, data_s = data_m[:, :], data_s[:, :]
         # test with lena/Venus image
 #        import scipy.io as sio
 #        conts = sio.loadmat(indir_m)
@@ -456,6 +1122,7 @@ def generateAutoriftProduct(indir_m, indir_s, grid_location, init_offset, search
     else:
         data_m = loadProduct(indir_m)
         data_s = loadProduct(indir_s)
+        scene_ids = [(name, (0, 0, d.shape[1], d.shape[0])) for name, d in ((indir_m, data_m), (indir_s, data_s))]
 
 
 
@@ -568,13 +1235,23 @@ def generateAutoriftProduct(indir_m, indir_s, grid_location, init_offset, search
 
         print(f'Using preprocessing methods {preprocessing_methods}')
 
-        Dx, Dy, InterpMask, ChipSizeX, GridSpacingX, ScaleChipSizeY, SearchLimitX, SearchLimitY, origSize, noDataMask = \
-            runAutorift(
-                data_m, data_s, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CSMAXx0, CSMAXy0,
-                noDataMask, optical_flag, nodata, mpflag, geogrid_run_info=geogrid_run_info,
-                preprocessing_methods=preprocessing_methods, preprocessing_filter_width=preprocessing_filter_width,
-                zero_mask=zero_mask
-            )
+        if tiled:
+            Dx, Dy, InterpMask, ChipSizeX, GridSpacingX, ScaleChipSizeY, SearchLimitX, SearchLimitY, origSize, noDataMask = \
+                runAutoriftTiled(
+                    data_m, data_s, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CSMAXx0, CSMAXy0,
+                    noDataMask, optical_flag, nodata, mpflag, tile_size, halo=kwargs.get('tile_halo'),
+                    geogrid_run_info=geogrid_run_info, preprocessing_methods=preprocessing_methods,
+                    preprocessing_filter_width=preprocessing_filter_width, zero_mask=zero_mask, workers=workers,
+                    scene_cache=scene_cache, scene_ids=scene_ids
+                )
+        else:
+            Dx, Dy, InterpMask, ChipSizeX, GridSpacingX, ScaleChipSizeY, SearchLimitX, SearchLimitY, origSize, noDataMask = \
+                runAutorift(
+                    data_m, data_s, xGrid, yGrid, Dx0, Dy0, SRx0, SRy0, CSMINx0, CSMINy0, CSMAXx0, CSMAXy0,
+                    noDataMask, optical_flag, nodata, mpflag, geogrid_run_info=geogrid_run_info,
+                    preprocessing_methods=preprocessing_methods, preprocessing_filter_width=preprocessing_filter_width,
+                    zero_mask=zero_mask, scene_cache=scene_cache, scene_ids=scene_ids
+                )
         if nc_sensor is not None:
             import hyp3_netcdf_output as no
             no.netCDF_packaging_intermediate(Dx, Dy, InterpMask, ChipSizeX, GridSpacingX, ScaleChipSizeY, SearchLimitX, SearchLimitY, origSize, noDataMask, intermediate_nc_file)